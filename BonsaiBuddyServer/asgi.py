@@ -3,6 +3,9 @@ ASGI config for BonsaiBuddyServer project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+This is how the app is served (see Procfile): the client API views are async,
+so one process can hold many idle long-polls and slow uploads at once.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
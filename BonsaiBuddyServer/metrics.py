@@ -0,0 +1,141 @@
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+import contextvars
+import threading
+import time
+
+
+# upper bounds of the histogram buckets (long-polls are held for up to 25 s)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# content type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# A Prometheus histogram: observations counted in cumulative buckets, per combination of label values
+class Histogram:
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, label_values, value):
+        with self.lock:
+            series = self.series.setdefault(label_values, [[0] * len(self.buckets), 0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self.lock:
+            self.series = {}
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((label_values, [list(counts), total, count])
+                            for label_values, (counts, total, count) in self.series.items())
+        for label_values, (counts, total, count) in series:
+            labels = ['%s="%s"' % (name, escape_label_value(value)) for name, value in zip(self.label_names, label_values)]
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket{%s} %d' % (self.name, ','.join(labels + ['le="%s"' % bound]), bucket_count))
+            lines.append('%s_bucket{%s} %d' % (self.name, ','.join(labels + ['le="+Inf"']), count))
+            lines.append('%s_sum{%s} %s' % (self.name, ','.join(labels), repr(float(total))))
+            lines.append('%s_count{%s} %d' % (self.name, ','.join(labels), count))
+        return lines
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram(
+    'bonsaibuddy_request_duration_seconds', 'Time spent handling requests, until the last byte of the response',
+    ('view', 'method', 'status'), DURATION_BUCKETS
+)
+request_queries = Histogram(
+    'bonsaibuddy_request_db_queries', 'Database queries run per request',
+    ('view', 'method'), QUERY_COUNT_BUCKETS
+)
+request_query_duration = Histogram(
+    'bonsaibuddy_request_db_duration_seconds', 'Time spent in database queries per request',
+    ('view', 'method'), DURATION_BUCKETS
+)
+response_size = Histogram(
+    'bonsaibuddy_response_size_bytes', 'Size of response bodies',
+    ('view', 'method'), SIZE_BUCKETS
+)
+
+HISTOGRAMS = [request_duration, request_queries, request_query_duration, response_size]
+
+
+# record one finished request; queries is a list of (sql, seconds)
+def observe_request(view, method, status, duration, queries, size):
+    request_duration.observe((view, method, str(status)), duration)
+    request_queries.observe((view, method), len(queries))
+    request_query_duration.observe((view, method), sum(seconds for _, seconds in queries))
+    response_size.observe((view, method), size)
+
+
+def clear_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
+
+
+# Queries are timed by a wrapper installed on every database connection, and added to the list of the
+# request being handled. The list is held in a context variable, since async views run their queries
+# in worker threads (with their own connections), which inherit the context of the request.
+current_queries = contextvars.ContextVar('current_queries', default=None)
+
+
+# start collecting the queries of a new request, and return their list
+def collect_queries():
+    queries = []
+    current_queries.set(queries)
+    return queries
+
+
+def record_query(execute, sql, params, many, context):
+    queries = current_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.append((sql, time.perf_counter() - started))
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+# for connections of the current thread opened before this module was imported
+def install_query_recorders():
+    for connection in connections.all(initialized_only=True):
+        install_query_recorder(connection)
+
+
+# The metrics of this process in the Prometheus text format
+def metrics(request):
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    return HttpResponse('\n'.join(lines) + '\n', content_type=METRICS_CONTENT_TYPE)
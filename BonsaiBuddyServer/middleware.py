@@ -0,0 +1,114 @@
+from django.conf import settings
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware as SyncWhiteNoiseMiddleware
+
+import logging
+import time
+
+from .metrics import collect_queries, install_query_recorders, observe_request
+
+
+logger = logging.getLogger('django')
+
+
+# WhiteNoise's middleware (added by django_heroku) is synchronous only, and a single synchronous
+# middleware makes Django run every view under ASGI, async ones included, in a worker thread.
+# This one serves static files the same way, but lets requests for views stay in the event loop.
+class WhiteNoiseMiddleware(SyncWhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
+
+
+# upper bound of the length of each query logged for a slow request
+SLOW_REQUEST_SQL_LENGTH = 500
+
+
+# Record the latency, database queries and response size of every request for /metrics, per view,
+# and log the requests slower than SLOW_REQUEST_THRESHOLD together with their queries.
+# Streamed responses are recorded once their last chunk is sent, so the queries run while streaming count too.
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        install_query_recorders()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        queries = collect_queries()
+        response = self.get_response(request)
+        return self.finish(request, response, started, queries)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        queries = collect_queries()
+        response = await self.get_response(request)
+        return self.finish(request, response, started, queries)
+
+    def finish(self, request, response, started, queries):
+        def done(size):
+            self.record(request, response, time.perf_counter() - started, queries, size)
+
+        if not response.streaming:
+            done(len(response.content))
+        elif response.is_async:
+            response.streaming_content = self.counted_async(response.streaming_content, done)
+        else:
+            response.streaming_content = self.counted(response.streaming_content, done)
+        return response
+
+    @staticmethod
+    def counted(chunks, done):
+        size = 0
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            done(size)
+
+    @staticmethod
+    async def counted_async(chunks, done):
+        size = 0
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        finally:
+            done(size)
+
+    @staticmethod
+    def record(request, response, duration, queries, size):
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        observe_request(view, request.method, response.status_code, duration, queries, size)
+
+        if settings.SLOW_REQUEST_THRESHOLD is not None and duration >= settings.SLOW_REQUEST_THRESHOLD:
+            logger.warning('Slow request: %s %s (%s) answered %d in %.0f ms, %d queries took %.0f ms%s' % (
+                request.method, request.get_full_path(), view, response.status_code, 1000 * duration,
+                len(queries), 1000 * sum(seconds for _, seconds in queries),
+                ''.join('\n%9.1f ms  %s' % (1000 * seconds, sql[:SLOW_REQUEST_SQL_LENGTH]) for sql, seconds in queries)
+            ))
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+from datetime import timedelta
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'BonsaiBuddyServer.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,6 +129,49 @@ STATIC_URL = '/static/'
 
 
 
+# Cache for rendered pages (see manager/cache.py)
+# Local memory is per process: when serving with several worker processes, set CACHE_BACKEND=file
+# so that writes handled by one process invalidate the pages cached by the others
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+
+CACHES = {
+    'default': {
+        'BACKEND': {
+            'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+            'file': 'django.core.cache.backends.filebased.FileBasedCache',
+        }[CACHE_BACKEND],
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache') if CACHE_BACKEND == 'file' else ''),
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+
+
+# Write sensor uploads in the background: sensor_update validates an upload, queues it and answers 202,
+# and one writer thread per process saves the queue in batched transactions (see manager/ingest_queue.py)
+# Queued uploads are lost if the process dies before writing them (clients keep no copy after a 2xx)
+SENSOR_INGEST_WRITE_BEHIND = os.environ.get('SENSOR_INGEST_WRITE_BEHIND') == '1'
+
+
+
+# Log requests taking at least this long (seconds), with their database queries, to the django logger
+# (unset: no slow request log). Latencies and query counts of all requests are served at /metrics.
+SLOW_REQUEST_THRESHOLD = float(os.environ['SLOW_REQUEST_THRESHOLD']) if os.environ.get('SLOW_REQUEST_THRESHOLD') else None
+
+
+
+# How long sensor data is kept at each resolution before `manage.py compact_readings` removes it
+# (None keeps it forever; rounded up to whole days). Raw readings are only removed once their rollups
+# are stored, and daily rollups must be kept at least as long as the other resolutions.
+SENSOR_DATA_RETENTION = {
+    'raw': timedelta(days=30),
+    'hour': timedelta(days=365),
+    'day': None,
+}
+
+
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
 
 LOGGING = {
@@ -172,3 +217,10 @@ LOGGING = {
 
 # Activate Django-Heroku.
 django_heroku.settings(locals())
+
+# Serve static files with a WhiteNoise middleware that also runs natively under ASGI
+MIDDLEWARE = [
+    'BonsaiBuddyServer.middleware.WhiteNoiseMiddleware' if middleware == 'whitenoise.middleware.WhiteNoiseMiddleware'
+    else middleware for middleware in MIDDLEWARE
+]
+
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from . import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls, name='admin'),
+    path('metrics', metrics.metrics, name='metrics'),
     path('', include('manager.urls')),
 ]
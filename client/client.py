@@ -1,35 +1,70 @@
-import requests
-from requests.compat import urljoin
 import json
 import threading, time, logging
+from collections import deque
 from random import random
 import signal
-import re
 import os
 
-from hardware_interfacing import read_moisture_sensor, read_light_sensor, pump_volume, cleanup_io
+from hardware_interfacing import read_analog_sensors, MOISTURE_SENSOR_CHANNEL, LIGHT_SENSOR_CHANNEL, cleanup_io
+from hardware_interfacing import pump_volume, pump_volume_with_target_pos, move_servo_to
+from commands import CommandRegistry, CommandError, position
+from transport import Transport, describe_failure, CONNECT_TIMEOUT
+from protocol import endpoint_url, TASKS_UPDATE_PATH, TASKS_WAIT_PATH, SENSOR_UPDATE_PATH, TASK_NOTIFICATION_PATH
+from protocol import sensor_reading, task_completion, sensor_update_payload, task_completions_payload
+from journal import Journal
+from scheduler import TaskScheduler
 
 
 # set logging output format
 logging.basicConfig(level=logging.INFO, format='%(threadName)s:\t%(message)s')
 
 
-# minium amount of time between event executions (seconds)
-EVENT_EXECUTION_PERIOD = 30
-
-# amount of time between GET/POST requests (seconds)
+# amount of time between sensor uploads (seconds); task changes are pushed by the server as they happen
 BATCH_UPDATE_PERIOD = 60 * 60   # every 60 minutes
 
+# amount of time between sensor samples (seconds)
+SAMPLE_PERIOD = 30
+
+# sensor names (as registered on the server) and their ADC channels
+SENSORS = [
+    ('Roberto Moisture Sensor', MOISTURE_SENSOR_CHANNEL),
+    ('Light Sensor', LIGHT_SENSOR_CHANNEL),
+]
+
+# maximum number of readings buffered between uploads (two upload periods' worth; oldest are dropped first)
+SAMPLE_BUFFER_SIZE = 2 * (BATCH_UPDATE_PERIOD // SAMPLE_PERIOD) * len(SENSORS)
+
+# how long the server holds a request for task changes open (seconds, below Heroku's 30 s router timeout)
+TASKS_WAIT_TIMEOUT = 25
+
+# amount of time to wait before watching for task changes again after a failed request (seconds)
+TASKS_WAIT_RETRY_PERIOD = 60
+
+# maximum number of journaled records uploaded per request
+REPLAY_BATCH_SIZE = 1000
+
+# amount of time to wait before retrying a failed upload of journaled records (seconds)
+REPLAY_RETRY_PERIOD = 5 * 60
+
+# kinds of journaled records
+READINGS = 'reading'
+COMPLETIONS = 'completion'
+
 
 BASE_URL = 'https://bonsai-buddy-controller.herokuapp.com/'
-TASKS_UPDATE_URL = urljoin(BASE_URL, 'next_tasks/')
-SENSOR_UPDATE_URL = urljoin(BASE_URL, 'sensor_update/')
-TASK_NOTIFICATION_URL = urljoin(BASE_URL, 'notify_task/')
+TASKS_UPDATE_URL = endpoint_url(BASE_URL, TASKS_UPDATE_PATH)
+TASKS_WAIT_URL = endpoint_url(BASE_URL, TASKS_WAIT_PATH)
+SENSOR_UPDATE_URL = endpoint_url(BASE_URL, SENSOR_UPDATE_PATH)
+TASK_NOTIFICATION_URL = endpoint_url(BASE_URL, TASK_NOTIFICATION_PATH)
 
 # UPLOAD_PASSWORD = os.environ.get('UPLOAD_PASSWORD')
 from secrets import UPLOAD_PASSWORD
 
 
+COMMANDS = CommandRegistry()
+
+
+@COMMANDS.register(r'NOOP')
 def do_nothing():
     print('Doing nothing!!!')
 
@@ -39,16 +74,36 @@ def do_nothing():
 #     'TEST_TARGET':  0.7
 # }
 
+@COMMANDS.register(r'pump (\d+)ml to (\w+)', int, str)
 def pump_volume_with_target_name(volume, target_name):
     # target_pos = TARGET_POS_MAP[target_name.upper()]
     # pump_volume_with_target_pos(int(volume), target_pos)
     pump_volume(volume)
 
 
-COMMANDS = [
-    (r'NOOP', do_nothing),
-    (r'pump (\d+)ml to (\w+)', pump_volume_with_target_name)
-]
+# route water to a diverter position directly (e.g. for plants without a target name)
+COMMANDS.register(r'pump (\d+)ml to position (\d*\.?\d+)', int, position)(pump_volume_with_target_pos)
+
+COMMANDS.register(r'move diverter to (\d*\.?\d+)', position)(move_servo_to)
+
+
+# whether content is a task list as served by next_tasks/
+def is_tasks_update(content):
+    return (isinstance(content, dict) and isinstance(content.get('scheduled_tasks'), list) and all(
+        isinstance(task, dict) and {'task_id', 'command', 'next_time'} <= task.keys()
+        for task in content['scheduled_tasks']
+    ))
+
+
+# the records of a successful upload that the server skipped, e.g. {'unknown_tasks': [12]}
+def skipped_records(response):
+    try:
+        content = response.json()
+    except ValueError:
+        return {}
+    if not isinstance(content, dict):
+        return {}
+    return {key: value for key, value in content.items() if key.startswith('unknown_') and value}
 
 
 class Client:
@@ -56,132 +111,253 @@ class Client:
         self.quit_event = threading.Event()
         self.tasks_worker = None
         self.status_updates_worker = None
+        self.task_watch_worker = None
+        self.collector_worker = None
+        self.replay_worker = None
         self.execution_lock = threading.RLock()
+        self.transport = Transport(self.quit_event)
+
+        # readings and task completions are journaled to disk, then uploaded by the replay worker
+        self.journal = Journal()
+        self.replay_event = threading.Event()
 
+        # task list last downloaded from the server, and the queue of its pending tasks
         self.scheduled_tasks = {}
+        self.scheduler = TaskScheduler()
+
+        # readings sampled by the collector worker, waiting for the next upload
+        self.sample_buffer = deque(maxlen=SAMPLE_BUFFER_SIZE)
+        self.sample_buffer_lock = threading.Lock()
+
+        # last downloaded task list and its ETag (the server answers 304 while it is unchanged)
+        self.tasks_update = None
+        self.tasks_etag = None
 
     # execute the given command; return an error message if execution fails
     def execute_command(self, command):
         logging.info('Executing command: "%s"... ' % command)
         error_message = None
-        matched = False
-        for com in COMMANDS:
-            pattern, function = com
-            match = re.fullmatch(pattern, command)
-            if match:
-                # print('match found! %s' % str(pattern))
-                matched = True
-                # call function with captured values as args
-                try:
-                    function(*match.groups())
-                except Exception as e:
-                    error_message = str(e)
-        
-        if not matched:
-            error_message = 'command "%s" not recognized' % command
+        start = time.perf_counter()
+        try:
+            function, args = COMMANDS.parse(command)
+        except CommandError as e:
+            error_message = str(e)
+        parsed = time.perf_counter()
+
+        if error_message is None:
+            # call function with captured (and converted) values as args
+            try:
+                function(*args)
+            except Exception as e:
+                error_message = str(e)
+        executed = time.perf_counter()
         
         if error_message is None:
-            logging.info('Command executed successfully')
+            logging.info('Command executed successfully (parsed in %0.3f ms, executed in %0.3f s)' %
+                         (1000 * (parsed - start), executed - parsed))
         else:
             logging.error('Command failed with error message: %s' % error_message)
         
         return error_message
+
+    # parse (and cache) the commands of downloaded tasks, so bad commands are reported before they are due
+    def validate_commands(self, tasks):
+        for task in tasks:
+            try:
+                COMMANDS.parse(task['command'])
+            except CommandError as e:
+                logging.error('Task #%s will fail: %s' % (task['task_id'], e))
     
-    # download the next tasks from the server
-    def get_tasks_update(self):
-        logging.info('Checking for task updates...')
-        response = requests.get(TASKS_UPDATE_URL)
-        if response.ok:
-            logging.info('Update downloaded successfully')
+    # download the next tasks from the server; return None if the download fails
+    # with wait=True the server holds the request until the tasks change (or TASKS_WAIT_TIMEOUT expires)
+    def get_tasks_update(self, wait=False):
+        logging.info('Waiting for task updates...' if wait else 'Checking for task updates...')
+        headers = {'If-None-Match': self.tasks_etag} if self.tasks_etag else {}
+        if wait:
+            response = self.transport.get(TASKS_WAIT_URL, headers=headers, params={'timeout': TASKS_WAIT_TIMEOUT},
+                                          timeout=(CONNECT_TIMEOUT, TASKS_WAIT_TIMEOUT + 10))
         else:
-            logging.error('Failed to download update with status code: %s (%s)' % (response.status_code, response.reason))
-        return response.json()
+            response = self.transport.get(TASKS_UPDATE_URL, headers=headers)
+        if response is not None and response.status_code == 304:
+            logging.info('Tasks unchanged since last update')
+            return self.tasks_update
+        if response is not None and response.ok:
+            try:
+                tasks_update = response.json()
+            except ValueError:
+                tasks_update = None
+            if not is_tasks_update(tasks_update):
+                # e.g. a proxy or captive portal page
+                logging.error('Failed to download update (unexpected response: %.200r)' % response.text)
+                return None
+            logging.info('Update downloaded successfully')
+            self.tasks_update = tasks_update
+            self.tasks_etag = response.headers.get('ETag')
+            return self.tasks_update
+        logging.error('Failed to download update (%s)' % describe_failure(response))
+        return None
+
+    # replace the scheduled tasks if the downloaded task list differs
+    # (after waiting for any in-progress commands to finish executing)
+    def install_tasks(self, tasks_update):
+        with self.execution_lock:
+            if self.scheduled_tasks == tasks_update['scheduled_tasks']:
+                logging.info('No new tasks found')
+                return
+            new_tasks = tasks_update['scheduled_tasks']
+            logging.info('New tasks found: %s' % new_tasks)
+            self.validate_commands(new_tasks)
+            self.scheduled_tasks = new_tasks
+            self.scheduler.set_tasks(new_tasks)
     
+    # sample every sensor within a single sampling window
+    def read_sensors(self):
+        current_time = round(time.time())
+        values = read_analog_sensors([channel for _, channel in SENSORS])
+        return [sensor_reading(name, value, current_time) for (name, _), value in zip(SENSORS, values)]
+
+    # journal the buffered readings for upload
     def post_sensor_update(self):
-        logging.info('Reading sensor values... ')
-        status_update = {
-            'password': UPLOAD_PASSWORD,
-            'sensors': [
-                {
-                    'sensor_name': 'Roberto Moisture Sensor',
-                    'value': read_moisture_sensor(),
-                    'time': round(time.time()),
-                },
-                {
-                    'sensor_name': 'Light Sensor',
-                    'value': read_light_sensor(),
-                    'time': round(time.time()),
-                }
-            ]
-        }
-        # print(status_update)
-        logging.info('Done')
+        with self.sample_buffer_lock:
+            readings = list(self.sample_buffer)
+            self.sample_buffer.clear()
+        if not readings:
+            return
+        logging.info('Queuing %d buffered readings for upload' % len(readings))
 
-        logging.info('Posting sensor update... ')
-        response = requests.post(SENSOR_UPDATE_URL, json=status_update)
-        if response.ok:
-            logging.info('Sensor update posted successfully')
-        else:
-            logging.error('Failed to post sensor update with status code: %s (%s)' % (response.status_code, response.reason))
-    
+        self.journal.append(READINGS, readings)
+        self.replay_event.set()
+
+    # journal the task's completion for upload
     def notify_task_completed(self, task):
-        logging.info('Posting task completion notification... ')
-        status_update = {
-            'password': UPLOAD_PASSWORD,
-            'task_id': task['task_id'],
-            'completion_time': round(time.time())   # TODO: fix internal server error with this response body
-        }
-        response = requests.post(TASK_NOTIFICATION_URL, json=status_update)
-        if response.ok:
-            logging.info('Task completion notification posted successfully')
-        else:
-            logging.error('Failed to post task completion notification with status code: %s (%s)' % (response.status_code, response.reason))
+        self.journal.append(COMPLETIONS, [task_completion(task['task_id'], round(time.time()))])
+        self.replay_event.set()
+
+    # POST a batch of journaled records; return True once the server has them (or rejected them for good)
+    # (the server applies a batch even if some of its records refer to sensors or tasks it no longer knows,
+    # skipping and reporting just those)
+    def upload(self, url, description, status_update):
+        logging.info('Posting %s... ' % description)
+        response = self.transport.post(url, json=status_update)
+        if response is not None and response.ok:
+            logging.info('Posted %s successfully' % description)
+            for unknown, names in skipped_records(response).items():
+                logging.warning('Server skipped the records of %s: %s' % (unknown.replace('_', ' '), names))
+            return True
+        if response is not None and response.status_code == 400:
+            # malformed: retrying cannot help
+            logging.error('Server rejected %s, dropping it: %s' % (description, response.text))
+            return True
+        logging.error('Failed to post %s (%s)' % (description, describe_failure(response)))
+        return False
+
+    def upload_sensor_readings(self, key, readings):
+        return self.upload(SENSOR_UPDATE_URL, 'sensor update (%d readings)' % len(readings),
+                           sensor_update_payload(UPLOAD_PASSWORD, key, readings))
+
+    def upload_task_completions(self, key, completions):
+        return self.upload(TASK_NOTIFICATION_URL, 'task completion notification (%d tasks)' % len(completions),
+                           task_completions_payload(UPLOAD_PASSWORD, key, completions))
+
+    # upload everything in the journal, oldest first; return False if an upload failed
+    def replay_journal(self):
+        for kind, upload in [(COMPLETIONS, self.upload_task_completions), (READINGS, self.upload_sensor_readings)]:
+            while not self.quit_event.is_set():
+                batch = self.journal.next_batch(kind, REPLAY_BATCH_SIZE)
+                if batch is None:
+                    break
+                key, records = batch
+                if not upload(key, records):
+                    return False
+                self.journal.complete_batch(kind)
+        return True
 
     def _run_tasks(self):
         time.sleep(1)   # allow self.start() to finish gracefully
-        while not self.quit_event.is_set():
-            current_time = time.time()
-            for task in self.scheduled_tasks:
-                if task['next_time'] <= current_time:
-                    logging.info('Queuing task #%s' % {task["task_id"]})
-                    with self.execution_lock:
-                        self.execute_command(task['command'])
-                        self.notify_task_completed(task)
-                        self.scheduled_tasks.remove(task)
-            self.quit_event.wait(EVENT_EXECUTION_PERIOD)
+        while True:
+            # sleeps until the next task is due (or a new task list is installed)
+            task = self.scheduler.next_due(self.quit_event)
+            if task is None:
+                break
+            logging.info('Queuing task #%s' % task['task_id'])
+            with self.execution_lock:
+                self.execute_command(task['command'])
+                self.notify_task_completed(task)
     
     def _run_updates(self):
         time.sleep(1)   # allow self.start() to finish gracefully
         while not self.quit_event.is_set():
-            # GET task updates from server (after waiting for any in-progress commands to finish executing)
-            with self.execution_lock:
-                new_tasks = self.get_tasks_update()['scheduled_tasks']
-                if self.scheduled_tasks == new_tasks:
-                    logging.info('No new tasks found')
-                else:
-                    logging.info('New tasks found: %s' % new_tasks)
-                    self.scheduled_tasks = new_tasks
-                
-            # POST sensor status update to server (after waiting for any in_progress commands to finish executing)
-            with self.execution_lock:
-                self.post_sensor_update()
+            # ship the readings collected since the last update
+            self.post_sensor_update()
             
             self.quit_event.wait(BATCH_UPDATE_PERIOD)
+
+    def _run_task_watch(self):
+        time.sleep(1)   # allow self.start() to finish gracefully
+        wait = False    # download the current task list first, then wait for changes to it
+        while not self.quit_event.is_set():
+            tasks_update = self.get_tasks_update(wait=wait)
+            if tasks_update is None:
+                logging.warning('Keeping current tasks')
+                wait = False
+                self.quit_event.wait(TASKS_WAIT_RETRY_PERIOD)
+                continue
+            self.install_tasks(tasks_update)
+            wait = True
+
+    def _run_collector(self):
+        next_time = time.time()
+        while not self.quit_event.is_set():
+            # read sensors (after waiting for any in_progress commands to finish executing)
+            with self.execution_lock:
+                readings = self.read_sensors()
+            with self.sample_buffer_lock:
+                self.sample_buffer.extend(readings)
+
+            # keep a steady cadence regardless of how long sampling took
+            next_time = max(next_time + SAMPLE_PERIOD, time.time())
+            self.quit_event.wait(next_time - time.time())
+
+    def _run_replay(self):
+        time.sleep(1)   # allow self.start() to finish gracefully
+        while not self.quit_event.is_set():
+            self.replay_event.clear()
+            if self.replay_journal():
+                # wait for new records to be journaled
+                self.replay_event.wait()
+            else:
+                # server unreachable: keep the records and try again later
+                self.replay_event.wait(REPLAY_RETRY_PERIOD)
     
     def start(self):
         self.quit_event.clear()
         self.tasks_worker = threading.Thread(target=self._run_tasks, name='TasksWorker', daemon=True)
         self.status_updates_worker = threading.Thread(target=self._run_updates, name='UpdatesWorker', daemon=True)
-        self.tasks_worker.start()
-        self.status_updates_worker.start()
-        logging.info('Client started with worker threads "%s" (%s) and "%s" (%s)' %
-                     (self.tasks_worker.name, self.tasks_worker.ident, self.status_updates_worker.name, self.status_updates_worker.ident))
+        self.task_watch_worker = threading.Thread(target=self._run_task_watch, name='TaskWatchWorker', daemon=True)
+        self.collector_worker = threading.Thread(target=self._run_collector, name='CollectorWorker', daemon=True)
+        self.replay_worker = threading.Thread(target=self._run_replay, name='ReplayWorker', daemon=True)
+        workers = [self.tasks_worker, self.status_updates_worker, self.task_watch_worker,
+                   self.collector_worker, self.replay_worker]
+        for worker in workers:
+            worker.start()
+        logging.info('Client started with worker threads %s' %
+                     ', '.join('"%s" (%s)' % (worker.name, worker.ident) for worker in workers))
     
     def stop(self):
         logging.info('Stopping all workers...')
         self.quit_event.set()
+        self.replay_event.set()
+        self.scheduler.wake()
         self.tasks_worker.join()
         self.status_updates_worker.join()
+        # (may be waiting on the server for task changes; it only downloads, so don't wait out the request)
+        self.task_watch_worker.join(timeout=1)
+        self.collector_worker.join()
+        self.replay_worker.join()
+        # keep readings collected since the last upload for the next run
+        self.post_sensor_update()
+        self.transport.close()
+        self.journal.close()
         cleanup_io()
         logging.info('Done')
     
@@ -0,0 +1,57 @@
+import re
+import functools
+
+
+class CommandError(Exception):
+    pass
+
+
+# Registry of task commands, each a regex pattern whose captured groups are passed to a function.
+# Patterns are compiled once and indexed by their leading keyword (e.g. 'pump'), so dispatching a
+# command only tries the patterns sharing its first word; the first full match wins.
+class CommandRegistry:
+    def __init__(self):
+        self.commands = {}      # keyword -> [(compiled pattern, converters, function)]
+        self.unindexed = []     # commands whose pattern does not start with a literal word
+        self.parse = functools.lru_cache(maxsize=256)(self._parse)
+
+    # decorator registering function for commands matching pattern; each captured group is
+    # passed through the corresponding converter (e.g. int), which raises ValueError if invalid
+    def register(self, pattern, *converters):
+        compiled = re.compile(pattern)
+        if len(converters) not in (0, compiled.groups):
+            raise ValueError('pattern "%s" has %d groups but %d converters' % (pattern, compiled.groups, len(converters)))
+        keyword = re.match(r'(\w+)(?: |$)', pattern)
+
+        def decorator(function):
+            entry = (compiled, converters, function)
+            if keyword:
+                self.commands.setdefault(keyword.group(1), []).append(entry)
+            else:
+                self.unindexed.append(entry)
+            self.parse.cache_clear()
+            return function
+        return decorator
+
+    # return (function, args) for the command, raising CommandError if it is unknown or its arguments are invalid
+    def _parse(self, command):
+        keyword = command.split(' ', 1)[0]
+        for pattern, converters, function in self.commands.get(keyword, []) + self.unindexed:
+            match = pattern.fullmatch(command)
+            if match:
+                args = match.groups()
+                try:
+                    if converters:
+                        args = tuple(convert(arg) for convert, arg in zip(converters, args))
+                except ValueError as e:
+                    raise CommandError('invalid arguments for command "%s": %s' % (command, e))
+                return function, args
+        raise CommandError('command "%s" not recognized' % command)
+
+
+# converter for diverter positions
+def position(value):
+    pos = float(value)
+    if not 0 <= pos <= 1:
+        raise ValueError('position %s is outside of [0, 1]' % value)
+    return pos
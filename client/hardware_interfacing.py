@@ -3,7 +3,6 @@ import time
 # SPI library (for hardware SPI) and MCP3008 (A2D) library.
 import Adafruit_GPIO.SPI as SPI
 import Adafruit_MCP3008
-import os
 
 from servo import Servo
 
@@ -16,24 +15,42 @@ mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE))
 MOISTURE_SENSOR_CHANNEL = 0
 LIGHT_SENSOR_CHANNEL    = 1
 
-# Return the mean of num_samples samples taken over period seconds
+# raw ADC value corresponding to a full-scale reading, for each sensor channel
+FULL_SCALE_VALUES = {
+    MOISTURE_SENSOR_CHANNEL: 850,   # max value of 850 confirmed empirically
+    LIGHT_SENSOR_CHANNEL:    1023,  # max value of 1023 confirmed empirically
+}
+
+# Return the mean of num_samples samples of each channel, taken over period seconds
+# All channels are read at each sample instant, so the sampling window does not grow with the number of channels
 # Not thread-safe (runs blocking)
-def sample_channel(channel, num_samples=5, period=2):
+def sample_channels(channels, num_samples=5, period=2):
     sample_period = period / (num_samples - 1)
-    total = 0
-    for _ in range(num_samples):
-        # raw value in range 0 - 1023
-        total += mcp.read_adc(channel)
-        time.sleep(sample_period)
-    return total / num_samples
+    totals = [0] * len(channels)
+    start = time.time()
+    for i in range(num_samples):
+        if i > 0:
+            time.sleep(max(0, start + i * sample_period - time.time()))
+        for j, channel in enumerate(channels):
+            # raw value in range 0 - 1023
+            totals[j] += mcp.read_adc(channel)
+    return [total / num_samples for total in totals]
+
+def sample_channel(channel, num_samples=5, period=2):
+    return sample_channels([channel], num_samples, period)[0]
+
+# Return the readings (normalized to 0 - 1) of the sensors on the given channels, sampled together
+def read_analog_sensors(channels):
+    return [
+        round(value / FULL_SCALE_VALUES[channel], 3)
+        for channel, value in zip(channels, sample_channels(channels))
+    ]
 
 def read_moisture_sensor():
-    # max value of 850 confirmed empirically
-    return round(sample_channel(MOISTURE_SENSOR_CHANNEL) / 850, 3)
+    return read_analog_sensors([MOISTURE_SENSOR_CHANNEL])[0]
 
 def read_light_sensor():
-    # max value of 1023 confirmed empirically
-    return round(sample_channel(LIGHT_SENSOR_CHANNEL) / 1023, 3)
+    return read_analog_sensors([LIGHT_SENSOR_CHANNEL])[0]
 
 
 
@@ -87,13 +104,18 @@ def pump_volume_with_target_pos(volume, target_pos):
     time.sleep(max(0, required - elapsed))
 
     
+# Diverter servo, driven in-process and kept running between moves (started on first use)
+servo = Servo(SERVO_PIN, 2, 12)
+
 def move_servo_to(pos):
-    command = 'python servo_move_to.py %d %0.3f' % (SERVO_PIN, pos)
-    # print(command)
-    os.system(command)
+    if servo.pwm_channel is None:
+        servo.start(pos=pos)
+    servo.move_to(pos)
 
 
 def cleanup_io():
+    if servo.pwm_channel is not None:
+        servo.stop()
     GPIO.cleanup()
 
 
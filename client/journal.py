@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+import json
+import uuid
+import os
+
+
+JOURNAL_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal.sqlite3')
+
+
+# Durable on-disk queue of records (sensor readings, task completions) waiting to be uploaded.
+# Records are taken off the queue in batches; a batch keeps its idempotency key and contents until it
+# is completed, so retrying an upload whose response was lost cannot apply it twice on the server.
+class Journal:
+    def __init__(self, filename=JOURNAL_FILENAME):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, record TEXT NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS batches (kind TEXT PRIMARY KEY, key TEXT NOT NULL, last_id INTEGER NOT NULL)'
+        )
+
+    # durably store the given records (JSON-serializable) of the given kind
+    def append(self, kind, records):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO records (kind, record) VALUES (?, ?)',
+                [(kind, json.dumps(record)) for record in records]
+            )
+
+    # return (idempotency key, records) of the oldest batch of at most max_size records, or None if empty
+    def next_batch(self, kind, max_size):
+        with self.lock, self.connection:
+            batch = self.connection.execute('SELECT key, last_id FROM batches WHERE kind = ?', (kind,)).fetchone()
+            if batch is None:
+                last = self.connection.execute(
+                    'SELECT MAX(id) FROM (SELECT id FROM records WHERE kind = ? ORDER BY id LIMIT ?)', (kind, max_size)
+                ).fetchone()[0]
+                if last is None:
+                    return None
+                batch = (uuid.uuid4().hex, last)
+                self.connection.execute('INSERT INTO batches (kind, key, last_id) VALUES (?, ?, ?)', (kind,) + batch)
+
+            key, last_id = batch
+            rows = self.connection.execute(
+                'SELECT record FROM records WHERE kind = ? AND id <= ? ORDER BY id', (kind, last_id)
+            ).fetchall()
+            return key, [json.loads(record) for record, in rows]
+
+    # drop the current batch of the given kind once it has been uploaded
+    def complete_batch(self, kind):
+        with self.lock, self.connection:
+            batch = self.connection.execute('SELECT last_id FROM batches WHERE kind = ?', (kind,)).fetchone()
+            if batch is not None:
+                self.connection.execute('DELETE FROM records WHERE kind = ? AND id <= ?', (kind, batch[0]))
+                self.connection.execute('DELETE FROM batches WHERE kind = ?', (kind,))
+
+    def pending(self, kind):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM records WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,241 @@
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+
+from transport import Transport, CONNECT_TIMEOUT, READ_TIMEOUT
+from protocol import endpoint_url, TASKS_UPDATE_PATH, TASKS_WAIT_PATH, SENSOR_UPDATE_PATH, TASK_NOTIFICATION_PATH
+from protocol import sensor_reading, task_completion, sensor_update_payload, task_completions_payload
+
+
+# Simulate a fleet of clients against a (local) server, each sending the same requests as client.Client:
+# task list polls (conditional, or long-polls), sensor uploads and task completion notifications.
+# Reports throughput, error rate and latency percentiles per kind of request.
+#
+#   python load_generator.py --url http://127.0.0.1:8000/ --devices 50 --duration 60 --upload-period 5
+
+
+logging.basicConfig(level=logging.INFO, format='%(threadName)s:\t%(message)s')
+
+
+DEFAULT_URL = 'http://127.0.0.1:8000/'
+
+# sensors registered on the server, sampled by every virtual device
+DEFAULT_SENSORS = ['Roberto Moisture Sensor', 'Light Sensor']
+
+# kinds of requests
+POLL = 'next_tasks'
+UPLOAD = 'sensor_update'
+COMPLETION = 'notify_task'
+
+
+# value at the given percentile (nearest rank) of the sorted values
+def percentile(sorted_values, percent):
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# Latencies and outcomes of the requests sent by every device
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {POLL: [], UPLOAD: [], COMPLETION: []}
+        self.errors = {POLL: 0, UPLOAD: 0, COMPLETION: 0}
+        self.samples = 0
+
+    def record(self, kind, latency, ok, samples=0):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            if not ok:
+                self.errors[kind] += 1
+            elif samples:
+                self.samples += samples
+
+    def report(self, duration):
+        kinds = {}
+        for kind, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            latencies = sorted(latencies)
+            kinds[kind] = {
+                'requests': len(latencies),
+                'errors': self.errors[kind],
+                'error_rate': self.errors[kind] / len(latencies),
+                'throughput': len(latencies) / duration,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p95_ms': 1000 * percentile(latencies, 95),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'max_ms': 1000 * latencies[-1],
+            }
+        return {
+            'duration': duration,
+            'requests': sum(len(latencies) for latencies in self.latencies.values()),
+            'errors': sum(self.errors.values()),
+            'samples_per_second': self.samples / duration,
+            'kinds': kinds,
+        }
+
+
+# One simulated Pi: runs each kind of request on its own cadence (starting at a random offset,
+# so the fleet does not send in lockstep) until quit_event is set. With --long-poll, task list polls
+# are instead held open back to back by a thread of their own, as in client.Client
+class VirtualDevice:
+    def __init__(self, number, args, stats, quit_event):
+        self.number = number
+        self.args = args
+        self.stats = stats
+        self.quit_event = quit_event
+        self.random = random.Random(number)
+        # failures are what is being measured, so don't retry them
+        read_timeout = args.wait_timeout + 10 if args.long_poll else READ_TIMEOUT
+        self.transport = Transport(quit_event, max_retries=0, timeout=(CONNECT_TIMEOUT, read_timeout))
+
+        self.tasks_etag = None
+        self.task_ids = []
+        self.next_sample_time = time.time() - args.readings_per_upload * args.sample_period
+
+    def run(self):
+        periods = [(self.upload_readings, self.args.upload_period)]
+        if not self.args.long_poll:
+            periods.append((self.poll_tasks, self.args.poll_period))
+        if self.args.completion_period > 0:
+            periods.append((self.notify_completion, self.args.completion_period))
+        start = time.monotonic()
+        queue = [(start + self.random.random() * period, i, action, period)
+                 for i, (action, period) in enumerate(periods)]
+        heapq.heapify(queue)
+
+        while not self.quit_event.is_set():
+            due, i, action, period = heapq.heappop(queue)
+            if self.quit_event.wait(max(0, due - time.monotonic())):
+                break
+            action()
+            heapq.heappush(queue, (max(due + period, time.monotonic()), i, action, period))
+
+    def run_long_poll(self):
+        while not self.quit_event.is_set():
+            if not self.poll_tasks():
+                self.quit_event.wait(1)
+
+    def timed(self, kind, send, ok_statuses=(200,), samples=0):
+        started = time.perf_counter()
+        response = send()
+        latency = time.perf_counter() - started
+        ok = response is not None and response.status_code in ok_statuses
+        self.stats.record(kind, latency, ok, samples)
+        if not ok and self.args.verbose:
+            logging.warning('Device %d: %s failed (%s)' % (
+                self.number, kind, 'no response' if response is None else response.status_code))
+        return response if ok else None
+
+    # fetch the task list if it changed (noting its task ids for completion notifications); return False on failure
+    def poll_tasks(self):
+        headers = {'If-None-Match': self.tasks_etag} if self.tasks_etag else {}
+        if self.args.long_poll:
+            send = lambda: self.transport.get(endpoint_url(self.args.url, TASKS_WAIT_PATH), headers=headers,
+                                              params={'timeout': self.args.wait_timeout})
+        else:
+            send = lambda: self.transport.get(endpoint_url(self.args.url, TASKS_UPDATE_PATH), headers=headers)
+        response = self.timed(POLL, send, ok_statuses=(200, 304))
+        if response is not None and response.status_code == 200:
+            self.tasks_etag = response.headers.get('ETag')
+            self.task_ids = [task['task_id'] for task in response.json()['scheduled_tasks']]
+        return response is not None
+
+    def upload_readings(self):
+        readings = []
+        for _ in range(self.args.readings_per_upload):
+            timestamp = round(self.next_sample_time)
+            readings += [sensor_reading(name, round(self.random.random(), 3), timestamp) for name in self.args.sensors]
+            self.next_sample_time += self.args.sample_period
+        payload = sensor_update_payload(self.args.password, uuid.uuid4().hex, readings)
+        self.timed(UPLOAD, lambda: self.transport.post(endpoint_url(self.args.url, SENSOR_UPDATE_PATH), json=payload),
+                   ok_statuses=(200, 202), samples=len(readings))
+
+    def notify_completion(self):
+        if not self.task_ids:
+            return
+        completions = [task_completion(self.random.choice(self.task_ids), round(time.time()))]
+        payload = task_completions_payload(self.args.password, uuid.uuid4().hex, completions)
+        self.timed(COMPLETION, lambda: self.transport.post(endpoint_url(self.args.url, TASK_NOTIFICATION_PATH), json=payload))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Simulate many BonsaiBuddy clients against a server')
+    parser.add_argument('--url', default=DEFAULT_URL, help='base URL of the server (default: %(default)s)')
+    parser.add_argument('--devices', type=int, default=10, help='number of simulated devices (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for (default: %(default)s)')
+    parser.add_argument('--poll-period', type=float, default=10,
+                        help='seconds between task list polls of a device (default: %(default)s)')
+    parser.add_argument('--long-poll', action='store_true',
+                        help='hold task list polls open on next_tasks/wait/, like the client does')
+    parser.add_argument('--wait-timeout', type=float, default=25,
+                        help='seconds a long-poll is held by the server (default: %(default)s)')
+    parser.add_argument('--upload-period', type=float, default=10,
+                        help='seconds between sensor uploads of a device (default: %(default)s)')
+    parser.add_argument('--readings-per-upload', type=int, default=120,
+                        help='readings of each sensor per upload (default: %(default)s)')
+    parser.add_argument('--sample-period', type=float, default=30,
+                        help='seconds between the simulated readings (default: %(default)s)')
+    parser.add_argument('--completion-period', type=float, default=60,
+                        help='seconds between task completions of a device, 0 for none (default: %(default)s)')
+    parser.add_argument('--sensor', action='append', dest='sensors',
+                        help='name of a sensor registered on the server (may be repeated; default: %s)' %
+                             ', '.join(DEFAULT_SENSORS))
+    parser.add_argument('--password', default=os.environ.get('UPLOAD_PASSWORD'),
+                        help='upload password (default: $UPLOAD_PASSWORD)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='log every failed request')
+    args = parser.parse_args()
+    args.sensors = args.sensors or DEFAULT_SENSORS
+    return args
+
+
+def main():
+    args = parse_args()
+    stats = Stats()
+    quit_event = threading.Event()
+    devices = [VirtualDevice(i, args, stats, quit_event) for i in range(args.devices)]
+    threads = [threading.Thread(target=device.run, name='Device-%d' % device.number, daemon=True) for device in devices]
+    if args.long_poll:
+        threads += [threading.Thread(target=device.run_long_poll, name='Device-%d-Poll' % device.number, daemon=True)
+                    for device in devices]
+
+    logging.info('Simulating %d devices against %s for %g s...' % (args.devices, args.url, args.duration))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    try:
+        quit_event.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    quit_event.set()
+    for thread in threads:
+        # (long-polls in flight are abandoned rather than waited out)
+        thread.join(timeout=1)
+    duration = time.monotonic() - started
+    for device in devices:
+        device.transport.close()
+
+    report = stats.report(duration)
+    print('%-14s %9s %7s %9s %9s %9s %9s %9s' % ('request', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for kind, result in report['kinds'].items():
+        print('%-14s %9d %6.1f%% %9.2f %9.1f %9.1f %9.1f %9.1f' % (
+            kind, result['requests'], 100 * result['error_rate'], result['throughput'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms']))
+    print('%d requests (%d errors) in %.1f s, %.1f samples/s ingested' % (
+        report['requests'], report['errors'], duration, report['samples_per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(report, devices=args.devices, url=args.url), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
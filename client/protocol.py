@@ -0,0 +1,52 @@
+from requests.compat import urljoin
+
+
+# Endpoints of the server and the bodies POSTed to them (kept free of hardware imports, so that
+# tools like load_generator.py can speak the same protocol as the client without a Pi)
+
+TASKS_UPDATE_PATH = 'next_tasks/'
+TASKS_WAIT_PATH = 'next_tasks/wait/'
+SENSOR_UPDATE_PATH = 'sensor_update/'
+TASK_NOTIFICATION_PATH = 'notify_task/'
+
+
+def endpoint_url(base_url, path):
+    return urljoin(base_url, path)
+
+
+# a sensor reading, as sampled by the client
+def sensor_reading(sensor_name, value, time):
+    return {
+        'sensor_name': sensor_name,
+        'value': value,
+        'time': time,
+    }
+
+
+# a task completion, as reported by the client
+def task_completion(task_id, time):
+    return {
+        'task_id': task_id,
+        'completion_time': time,
+    }
+
+
+# body of a sensor_update POST: the readings grouped into per-sensor [time, value] samples
+def sensor_update_payload(password, idempotency_key, readings):
+    samples = {}
+    for reading in readings:
+        samples.setdefault(reading['sensor_name'], []).append([reading['time'], reading['value']])
+    return {
+        'password': password,
+        'idempotency_key': idempotency_key,
+        'sensors': [{'sensor_name': name, 'samples': s} for name, s in samples.items()]
+    }
+
+
+# body of a notify_task POST reporting a batch of task completions
+def task_completions_payload(password, idempotency_key, completions):
+    return {
+        'password': password,
+        'idempotency_key': idempotency_key,
+        'completions': completions
+    }
@@ -0,0 +1,41 @@
+import heapq
+import threading
+import time
+
+
+# Priority queue of tasks keyed on their 'next_time', which sleeps exactly until the next one is due
+class TaskScheduler:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        # (task_id, next_time) of every task handed out, so that reinstalling a task list
+        # the server has not updated yet cannot run the same occurrence twice
+        self.dispatched = set()
+
+    # replace the pending tasks, waking the waiting worker so it can reschedule
+    def set_tasks(self, tasks):
+        with self.condition:
+            self.queue = [
+                (task['next_time'], i, task) for i, task in enumerate(tasks)
+                if (task['task_id'], task['next_time']) not in self.dispatched
+            ]
+            heapq.heapify(self.queue)
+            self.dispatched &= {(task['task_id'], task['next_time']) for task in tasks}
+            self.condition.notify_all()
+
+    # block until a task is due and return it, or return None once quit_event is set
+    def next_due(self, quit_event):
+        with self.condition:
+            while not quit_event.is_set():
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    _, _, task = heapq.heappop(self.queue)
+                    self.dispatched.add((task['task_id'], task['next_time']))
+                    return task
+                self.condition.wait(self.queue[0][0] - now if self.queue else None)
+            return None
+
+    # wake the waiting worker (e.g. after setting its quit event)
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
@@ -4,11 +4,17 @@ import time
 
 class Servo:
     PWM_FREQUENCY = 50
+
+    # seconds for the arm to sweep the full range (pos 0 to 1), and to settle after any move
+    FULL_TRAVEL_TIME = 0.6
+    SETTLE_TIME = 0.1
     
     def __init__(self, pin, min_duty_cycle, max_duty_cycle):
         self.pin = pin
         self.min_duty_cycle = float(min_duty_cycle)
         self.max_duty_cycle = float(max_duty_cycle)
+        self.pwm_channel = None
+        self.pos = None     # last position reached (None if unknown)
 
     def instantiate_pwm_channel(self):
         # Create PWM channel on the servo pin with frequency 50Hz
@@ -28,9 +34,12 @@ class Servo:
         if duty_cycle is None:
             duty_cycle = self.pos_to_duty_cycle(pos)
         self.pwm_channel.start(duty_cycle)
+        # the arm may start anywhere, so the first move waits for a full sweep
+        self.pos = None
 
     def stop(self):
         self.pwm_channel.stop()
+        self.pwm_channel = None
         GPIO.cleanup(self.pin)
 
     def pause(self):
@@ -48,8 +57,16 @@ class Servo:
             self.pwm_channel.ChangeDutyCycle(duty_cycle)
             time.sleep(step_time)
 
+    # time needed to reach pos from the current position
+    def travel_time(self, pos):
+        distance = 1 if self.pos is None else abs(pos - self.pos)
+        return distance * self.FULL_TRAVEL_TIME + self.SETTLE_TIME
+
+    # move to pos and wait until the arm gets there, then stop driving it (avoids jitter while holding)
     def move_to(self, pos):
         duty_cycle = self.pos_to_duty_cycle(pos)
         self.pwm_channel.ChangeDutyCycle(duty_cycle)
-        time.sleep(1)
+        time.sleep(self.travel_time(pos))
+        self.pause()
+        self.pos = pos
     
@@ -0,0 +1,69 @@
+import requests
+from requests.adapters import HTTPAdapter
+import threading, logging
+from random import random
+
+
+# seconds to wait for a connection to the server / for the server to respond
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# retry attempts after the first request, and the backoff bounds between them (seconds)
+MAX_RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# responses worth retrying (the server is overloaded or restarting)
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+# Shared keep-alive HTTP session with timeouts and retries (exponential backoff with full jitter)
+class Transport:
+    def __init__(self, quit_event=None, max_retries=MAX_RETRIES, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        # waiting on quit_event between retries lets the client stop without waiting out the backoff
+        self.quit_event = quit_event or threading.Event()
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def backoff(self, attempt):
+        return random() * min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+
+    # send the request, retrying transient failures; return the response, or None if none was received
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                logging.warning('%s %s returned status code %s' % (method, url, response.status_code))
+            except requests.RequestException as e:
+                logging.warning('%s %s failed: %s' % (method, url, e))
+
+            if attempt < self.max_retries:
+                delay = self.backoff(attempt)
+                logging.info('Retrying in %0.1f seconds (attempt %d of %d)' % (delay, attempt + 2, self.max_retries + 1))
+                if self.quit_event.wait(delay):
+                    break
+        return None
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+# describe why a request made through Transport.request failed
+def describe_failure(response):
+    if response is None:
+        return 'no response from server'
+    return 'status code: %s (%s)' % (response.status_code, response.reason)
@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Task, Sensor, SensorReading, Plant
+from .models import Task, TaskRun, Sensor, SensorReading, SensorRollup, Plant
 
 admin.site.register(Task)
+admin.site.register(TaskRun)
 admin.site.register(Sensor)
 admin.site.register(SensorReading)
+admin.site.register(SensorRollup)
 admin.site.register(Plant)
\ No newline at end of file
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ManagerConfig(AppConfig):
     name = 'manager'
+
+    def ready(self):
+        # connect the receivers that invalidate cached pages
+        from . import signals
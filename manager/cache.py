@@ -0,0 +1,78 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+from functools import wraps
+import hashlib
+import uuid
+
+
+# longest a rendered page is served from the cache (this also bounds how stale
+# time-dependent content, like the client status on the home page, can get)
+PAGE_CACHE_TIMEOUT = 5 * 60
+
+
+# Cached pages are stored under the current versions of the scopes they show: a whole collection
+# ('sensors', 'tasks', 'plants') or a single object ('sensor:3'). Writes replace the versions of the
+# scopes they touch, so pages rendered before a write are never looked up again (and simply expire).
+# Versions are random rather than counters, so a version evicted from the cache cannot come back.
+
+def sensor_scopes(sensor_ids):
+    return ['sensors'] + ['sensor:%d' % sensor_id for sensor_id in sensor_ids]
+
+def task_scopes(task_ids):
+    return ['tasks'] + ['task:%d' % task_id for task_id in task_ids]
+
+def plant_scopes(plant_ids):
+    return ['plants'] + ['plant:%d' % plant_id for plant_id in plant_ids]
+
+
+def version_key(scope):
+    return 'version:%s' % scope
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+# current versions of the given scopes (one cache round trip)
+def get_versions(scopes):
+    keys = [version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+# invalidate every cached page showing the given scopes
+def bump_versions(scopes):
+    def bump():
+        cache.set_many({version_key(scope): new_version() for scope in scopes}, timeout=None)
+    bump()
+    # and again once the write is committed, in case a page was rendered from the old data in between
+    transaction.on_commit(bump)
+
+
+# Serve the view's successful GET responses from the cache until the versions of
+# scopes(request, *args, **kwargs) change (or PAGE_CACHE_TIMEOUT expires)
+def cache_page_versioned(scopes):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+
+            versions = get_versions(scopes(request, *args, **kwargs))
+            key = 'page:' + hashlib.md5(':'.join([request.get_full_path()] + versions).encode()).hexdigest()
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, (response.content, response['Content-Type']), PAGE_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,48 @@
+"""
+Shape-preserving downsampling of (x, y) time series for charting
+"""
+
+
+# Largest-Triangle-Three-Buckets (Steinarsson, 2013)
+# Reduces points (a list of (x, y) pairs sorted by x) to at most threshold points,
+# keeping the first and last points and the visually most significant point of each bucket
+def lttb(points, threshold):
+    n = len(points)
+    if threshold >= n or threshold == 0:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    # the first and last points are always kept, so the rest is split into threshold - 2 buckets
+    bucket_size = (n - 2) / (threshold - 2)
+    a = 0   # index of the previously selected point
+
+    for i in range(threshold - 2):
+        # range of the current bucket
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        # average of the next bucket (the third vertex of the triangle)
+        next_start = end
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        next_count = next_end - next_start
+        avg_x = sum(p[0] for p in points[next_start:next_end]) / next_count
+        avg_y = sum(p[1] for p in points[next_start:next_end]) / next_count
+
+        # pick the point in the current bucket forming the largest triangle
+        ax, ay = points[a]
+        max_area = -1
+        max_index = start
+        for j in range(start, end):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        sampled.append(points[max_index])
+        a = max_index
+
+    sampled.append(points[-1])
+    return sampled
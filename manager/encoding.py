@@ -0,0 +1,50 @@
+"""
+Compact binary encoding of (x, y) time series for the sensor charts
+
+Layout (all little-endian):
+    4 bytes     magic b'BBSD'
+    uint32      number of points n
+    uint32      base timestamp (unix seconds of the first point)
+    n x uint32  seconds since the base timestamp
+    n x float32 values
+"""
+
+from array import array
+import struct
+import sys
+
+
+SERIES_MAGIC = b'BBSD'
+SERIES_HEADER = struct.Struct('<4sII')
+
+SERIES_CONTENT_TYPE = 'application/octet-stream'
+
+# range of the timestamps that can be encoded (unix seconds, stored as uint32: 1970 to 2106)
+SERIES_MIN_TIME = 0
+SERIES_MAX_TIME = 2 ** 32 - 1
+
+
+# Raises ValueError if a timestamp is outside [SERIES_MIN_TIME, SERIES_MAX_TIME]
+def encode_series(points):
+    times = [round(x) for x, _ in points]
+    if times and (min(times) < SERIES_MIN_TIME or max(times) > SERIES_MAX_TIME):
+        raise ValueError('series times out of the binary encoding\'s range (%d to %d)' % (SERIES_MIN_TIME, SERIES_MAX_TIME))
+    base = times[0] if times else 0
+    deltas = array('I', (t - base for t in times))
+    values = array('f', (y for _, y in points))
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+        values.byteswap()
+    return SERIES_HEADER.pack(SERIES_MAGIC, len(points), base) + deltas.tobytes() + values.tobytes()
+
+
+def decode_series(data):
+    magic, count, base = SERIES_HEADER.unpack_from(data)
+    if magic != SERIES_MAGIC:
+        raise ValueError('not a sensor series')
+    deltas = array('I', data[SERIES_HEADER.size:SERIES_HEADER.size + 4 * count])
+    values = array('f', data[SERIES_HEADER.size + 4 * count:SERIES_HEADER.size + 8 * count])
+    if sys.byteorder == 'big':
+        deltas.byteswap()
+        values.byteswap()
+    return [(base + delta, value) for delta, value in zip(deltas, values)]
@@ -0,0 +1,159 @@
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
+from datetime import datetime
+import logging
+
+from .models import Task, TaskRun, Sensor, SensorReading, SensorRollup, UploadReceipt
+from .cache import bump_versions, sensor_scopes
+from .encoding import SERIES_MIN_TIME, SERIES_MAX_TIME
+
+
+logger = logging.getLogger('tasks')
+
+
+# number of readings inserted per INSERT statement
+INGEST_BATCH_SIZE = 500
+
+
+# Flatten the 'sensors' list of a sensor update into (sensor_name, timestamp, value) samples.
+# Each entry holds either a single reading:
+#   {"sensor_name": ..., "value": ..., "time": ...}
+# or many buffered readings for the same sensor:
+#   {"sensor_name": ..., "samples": [[time, value], ...]}
+# Raises KeyError, TypeError or ValueError if the update is malformed
+def parse_sensor_update(sensors):
+    samples = []
+    for s in sensors:
+        name = s['sensor_name']
+        if not isinstance(name, str):
+            raise TypeError('sensor_name must be a string, not %r' % (name,))
+        if 'samples' in s:
+            samples += [(name, float(time), value) for time, value in s['samples']]
+        else:
+            samples.append((name, float(s['time']), s['value']))
+    return samples
+
+
+# Raises ValidationError unless the timestamp (unix seconds) of what (e.g. a sensor name) can be saved
+# (and served: sensor series are sent with timestamps in the binary encoding's range)
+def validate_timestamp(timestamp, what):
+    if not SERIES_MIN_TIME <= timestamp <= SERIES_MAX_TIME:
+        raise ValidationError('invalid time for %s: %r is not between %d and %d' % (
+            what, timestamp, SERIES_MIN_TIME, SERIES_MAX_TIME))
+    try:
+        datetime.fromtimestamp(timestamp)
+    except (ValueError, OverflowError, OSError) as e:
+        raise ValidationError('invalid time for %s: %s' % (what, e))
+
+
+# Check that the given (sensor_name, timestamp, value) samples can be saved
+# (so that uploads queued for writing in the background cannot fail once accepted)
+# Raises ValidationError for out of range timestamps and values that don't fit SensorReading.value
+def validate_samples(samples):
+    field = SensorReading._meta.get_field('value')
+    # values must have at most max_digits - decimal_places digits before the decimal point
+    limit = 10 ** (field.max_digits - field.decimal_places)
+    for name, time, value in samples:
+        validate_timestamp(time, name)
+        decimal_value = field.to_python(value)
+        if decimal_value is None or not decimal_value.is_finite() or abs(decimal_value) >= limit:
+            raise ValidationError('invalid value for %s: %r' % (name, value))
+
+
+# Record an upload's idempotency key (inside the upload's transaction)
+# Returns False if an upload with the same key was already applied
+# The receipt is inserted rather than looked up first: on SQLite, a transaction that reads before
+# writing cannot upgrade its lock while another upload writes, and fails at once instead of waiting
+def claim_upload(idempotency_key):
+    if idempotency_key is None:
+        return True
+    try:
+        with transaction.atomic():
+            UploadReceipt.objects.create(key=idempotency_key)
+    except IntegrityError:
+        return False
+    return True
+
+
+# Save the given (sensor_name, timestamp, value) samples in a single transaction
+# Samples of unknown sensors are skipped; returns the sorted names of those sensors
+def ingest_readings(samples, idempotency_key=None):
+    return ingest_uploads([(samples, idempotency_key)])
+
+
+# Save the samples of several uploads, given as (samples, idempotency_key) pairs, in a single transaction
+# (uploads whose key was already applied, even earlier in the same batch, are skipped)
+# Samples of unknown sensors (e.g. deleted or renamed while the client was offline) are skipped rather than
+# failing the whole upload, which holds the readings of other sensors; returns the sorted names of those sensors
+def ingest_uploads(uploads):
+    names = {name for samples, _ in uploads for name, _, _ in samples}
+    sensors = {sensor.name: sensor for sensor in Sensor.objects.filter(name__in=names)}
+    unknown = sorted(names - sensors.keys())
+    if unknown:
+        logger.warning('Skipping readings of unknown sensor(s): %s' % ', '.join(unknown))
+
+    with transaction.atomic():
+        new_readings = []
+        for samples, idempotency_key in uploads:
+            if not claim_upload(idempotency_key):
+                continue
+            new_readings += [
+                SensorReading(
+                    sensor=sensors[name],
+                    value=value,
+                    time=datetime.fromtimestamp(time)
+                ) for name, time, value in samples if name in sensors
+            ]
+        if new_readings:
+            SensorReading.objects.bulk_create(new_readings, batch_size=INGEST_BATCH_SIZE)
+            Sensor.refresh_latest_readings([sensor.id for sensor in sensors.values()])
+            SensorRollup.update_rollups(new_readings)
+            # bulk inserts send no signals, so invalidate the cached pages here
+            bump_versions(sensor_scopes(sensor.id for sensor in sensors.values()))
+
+    return unknown
+
+
+# Flatten a task completion notification into (task_id, timestamp) completions. It holds either
+# a single completion ({"task_id": ..., "completion_time": ...}) or a batch of them under "completions"
+# Raises KeyError, TypeError or ValueError if the notification is malformed
+def parse_task_completions(content):
+    completions = content['completions'] if 'completions' in content else [content]
+    return [(int(c['task_id']), float(c['completion_time'])) for c in completions]
+
+
+# Check that the given (task_id, timestamp) completions can be saved
+# Raises ValidationError for out of range timestamps
+def validate_completions(completions):
+    for task_id, time in completions:
+        validate_timestamp(time, 'task #%s' % task_id)
+
+
+# Mark the given (task_id, timestamp) completions, and record them as task runs, in a single transaction
+# Completions of unknown (e.g. deleted) tasks are skipped, so they cannot hold back the others;
+# returns the sorted ids of those tasks
+def complete_tasks(completions, idempotency_key=None):
+    task_ids = {task_id for task_id, _ in completions}
+    tasks = Task.objects.in_bulk(task_ids)
+    unknown = sorted(task_ids - tasks.keys())
+    if unknown:
+        logger.warning('Skipping completions of unknown task(s): %s' % ', '.join(map(str, unknown)))
+
+    with transaction.atomic():
+        if not claim_upload(idempotency_key):
+            return unknown
+        runs = []
+        for task_id, time in completions:
+            task = tasks.get(task_id)
+            if task is None:
+                continue
+            completion_time = datetime.fromtimestamp(time)
+            # completions replayed after an outage must not move a task back in time
+            if completion_time > task.last_completed_time:
+                task.last_completed_time = completion_time
+                task.save()
+            runs.append(TaskRun(task=task, completed_at=completion_time))
+            logger.info(f'Task #{task.id} (\"{task.name}\") completed at {completion_time}')
+        TaskRun.objects.bulk_create(runs)
+    return unknown
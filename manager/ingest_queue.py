@@ -0,0 +1,118 @@
+from django.db import OperationalError, close_old_connections
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from .ingest import ingest_uploads
+
+
+logger = logging.getLogger('django')
+
+
+# maximum number of uploads waiting to be written (sensor_update answers 503 while the queue is full)
+INGEST_QUEUE_SIZE = 1000
+
+# the writer commits once it has gathered this many samples,
+# or this long (seconds) after taking the first upload of the batch
+WRITE_BATCH_SIZE = 5000
+WRITE_BATCH_DELAY = 0.5
+
+# attempts at writing a batch while the database is busy (e.g. locked by another writer),
+# and the delay between them (seconds)
+WRITE_ATTEMPTS = 5
+WRITE_RETRY_DELAY = 1
+
+# how long (seconds) an exiting process waits for queued uploads to be written
+SHUTDOWN_TIMEOUT = 10
+
+
+# Write-behind queue of validated sensor uploads, drained by a single background writer thread
+# that saves them in batched transactions (see SENSOR_INGEST_WRITE_BEHIND)
+class IngestQueue:
+    def __init__(self, max_size=INGEST_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY):
+        self.queue = queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    # queue an upload's (sensor_name, timestamp, value) samples for writing
+    # Raises queue.Full if the writer has fallen too far behind
+    def put(self, samples, idempotency_key=None):
+        self.start()
+        self.queue.put_nowait((samples, idempotency_key))
+
+    # start the writer thread (once per process, on first use)
+    def start(self):
+        with self.writer_lock:
+            if self.writer is None:
+                atexit.register(self.flush, SHUTDOWN_TIMEOUT)
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self._run_writer, name='IngestWriter', daemon=True)
+                self.writer.start()
+
+    # wait until every upload queued so far is written; return False on timeout
+    def flush(self, timeout=None):
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks, timeout)
+
+    # block for the next upload, then gather more until the batch is full or its delay expires
+    def next_batch(self):
+        batch = [self.queue.get()]
+        samples = len(batch[0][0])
+        deadline = time.monotonic() + self.batch_delay
+        while samples < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            samples += len(batch[-1][0])
+        return batch
+
+    # The uploads of a batch were all acknowledged already, so if the batch cannot be written
+    # (other than while the database is busy), write its uploads one at a time to only lose the failing one
+    # (samples of sensors deleted since their upload was queued are skipped, see ingest_uploads)
+    def write(self, batch):
+        try:
+            self.write_retrying(batch)
+        except Exception:
+            if len(batch) == 1:
+                raise
+            logger.exception('Failed to write %d queued sensor uploads, writing them one at a time' % len(batch))
+            for upload in batch:
+                try:
+                    self.write_retrying([upload])
+                except Exception:
+                    logger.exception('Dropped queued sensor upload (%d samples)' % len(upload[0]))
+
+    def write_retrying(self, uploads):
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                return ingest_uploads(uploads)
+            except OperationalError as e:
+                if attempt == WRITE_ATTEMPTS:
+                    raise
+                logger.warning('Failed to write queued sensor uploads (%s), retrying (attempt %d of %d)' % (
+                    e, attempt + 1, WRITE_ATTEMPTS))
+                time.sleep(WRITE_RETRY_DELAY)
+
+    def _run_writer(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                close_old_connections()
+                self.write(batch)
+            except Exception:
+                logger.exception('Failed to write %d queued sensor uploads' % len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+ingest_queue = IngestQueue()
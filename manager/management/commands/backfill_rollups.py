@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manager.cache import bump_versions, sensor_scopes
+from manager.models import Sensor, SensorReading, SensorRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the hourly and daily rollups of every bucket that still has raw sensor readings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensor', type=int, action='append', dest='sensor_ids',
+                            help='only backfill the sensor with this id (may be repeated)')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='number of readings fetched from the database at a time')
+
+    def handle(self, *args, sensor_ids=None, chunk_size=2000, **options):
+        sensors = Sensor.objects.order_by('id')
+        if sensor_ids:
+            sensors = sensors.filter(pk__in=sensor_ids)
+
+        for sensor in sensors:
+            readings = SensorReading.objects.filter(sensor=sensor).order_by('time') \
+                .only('sensor', 'value', 'time').iterator(chunk_size=chunk_size)
+            buckets = SensorRollup.aggregate(readings)
+            if not buckets:
+                continue
+
+            with transaction.atomic():
+                # raw readings are contiguous (compaction only removes the oldest ones),
+                # so every stored bucket between the first and last raw bucket gets replaced
+                for resolution, _ in SensorRollup.RESOLUTIONS:
+                    starts = [start for _, res, start in buckets if res == resolution]
+                    SensorRollup.objects.filter(
+                        sensor=sensor, resolution=resolution, start__gte=min(starts), start__lte=max(starts)
+                    ).delete()
+                SensorRollup.objects.bulk_create(buckets.values(), batch_size=500)
+            # (bulk writes send no signals; this also changes the ETags of the sensor's data)
+            bump_versions(sensor_scopes([sensor.id]))
+
+            self.stdout.write(f'{sensor}: {len(buckets)} rollups')
@@ -0,0 +1,250 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from unittest import mock
+
+import django
+
+from manager import views
+from manager.ingest import ingest_readings
+from manager.models import Task, Sensor, Plant
+
+
+# number of synthetic readings ingested per transaction while generating the dataset
+GENERATE_CHUNK_SIZE = 20000
+
+# password sent with the benchmarked uploads
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+# Fill the database with sensors (readings every reading_period seconds over the last `days` days,
+# with their rollups and latest reading pointers), tasks, and plants that each use a few of them
+def generate_dataset(sensors, days, reading_period, tasks, plants, seed=0, progress=None):
+    rng = random.Random(seed)
+    now = datetime.now().replace(microsecond=0)
+    first_time = (now - timedelta(days=days)).timestamp()
+    readings_per_sensor = int(days * 24 * 60 * 60 // reading_period)
+
+    created_sensors = []
+    for i in range(sensors):
+        sensor = Sensor.objects.create(name=f'benchmark sensor {i}')
+        created_sensors.append(sensor)
+        # a daily cycle plus noise, within the range of SensorReading.value
+        phase = rng.random() * 2 * math.pi
+        for chunk_start in range(0, readings_per_sensor, GENERATE_CHUNK_SIZE):
+            samples = []
+            for j in range(chunk_start, min(chunk_start + GENERATE_CHUNK_SIZE, readings_per_sensor)):
+                timestamp = first_time + j * reading_period
+                value = 0.5 + 0.4 * math.sin(phase + 2 * math.pi * timestamp / 86400) + rng.uniform(-0.05, 0.05)
+                samples.append((sensor.name, timestamp, round(value, 3)))
+            ingest_readings(samples)
+        if progress:
+            progress(f'Sensor {i + 1}/{sensors}: {readings_per_sensor} readings')
+
+    new_tasks = []
+    for i in range(tasks):
+        task = Task(
+            name=f'benchmark task {i}',
+            description='',
+            command='NOOP',
+            period=timedelta(hours=rng.randint(1, 7 * 24)),
+            last_completed_time=now - timedelta(minutes=rng.randint(0, 7 * 24 * 60)),
+            enabled=rng.random() < 0.9,
+        )
+        # (bulk_create skips Task.save)
+        task.next_run_at = task.next_scheduled_time
+        new_tasks.append(task)
+    created_tasks = Task.objects.bulk_create(new_tasks, batch_size=500)
+    if not connection.features.can_return_rows_from_bulk_insert:
+        created_tasks = list(Task.objects.filter(name__startswith='benchmark task '))
+
+    created_plants = Plant.objects.bulk_create(
+        [Plant(name=f'benchmark plant {i}') for i in range(plants)], batch_size=500
+    )
+    if not connection.features.can_return_rows_from_bulk_insert:
+        created_plants = list(Plant.objects.filter(name__startswith='benchmark plant '))
+    plant_tasks, plant_sensors = [], []
+    for plant in created_plants:
+        for task in rng.sample(created_tasks, min(len(created_tasks), rng.randint(1, 3))):
+            plant_tasks.append(Plant.tasks.through(plant=plant, task=task))
+        for sensor in rng.sample(created_sensors, min(len(created_sensors), rng.randint(1, 3))):
+            plant_sensors.append(Plant.sensors.through(plant=plant, sensor=sensor))
+    Plant.tasks.through.objects.bulk_create(plant_tasks, batch_size=500)
+    Plant.sensors.through.objects.bulk_create(plant_sensors, batch_size=500)
+
+    return {
+        'sensors': created_sensors,
+        'tasks': created_tasks,
+        'plants': created_plants,
+        'last_reading_time': first_time + (readings_per_sensor - 1) * reading_period,
+    }
+
+
+# value at the given percentile (nearest rank) of the sorted values
+def percentile(sorted_values, percent):
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Command(BaseCommand):
+    help = ('Generate a synthetic dataset in a throwaway test database, then time the main endpoints '
+            '(p50/p99 latency, queries per request, peak memory) and optionally write the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sensors', type=int, default=20, help='number of sensors (default: %(default)s)')
+        parser.add_argument('--days', type=float, default=365,
+                            help='days of readings per sensor (default: %(default)s)')
+        parser.add_argument('--reading-period', type=float, default=3600,
+                            help='seconds between readings of a sensor (default: %(default)s)')
+        parser.add_argument('--tasks', type=int, default=300, help='number of tasks (default: %(default)s)')
+        parser.add_argument('--plants', type=int, default=200, help='number of plants (default: %(default)s)')
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='timed requests per scenario (default: %(default)s)')
+        parser.add_argument('--upload-size', type=int, default=240,
+                            help='samples per benchmarked sensor_update upload (default: %(default)s)')
+        parser.add_argument('--warm-cache', action='store_true',
+                            help='let pages be served from the page cache (by default it is cleared before every request)')
+        parser.add_argument('--seed', type=int, default=0, help='random seed of the dataset and requests')
+        parser.add_argument('--output', help='write the results to this JSON file')
+        parser.add_argument('--current-database', action='store_true',
+                            help='use the configured database instead of a throwaway test database '
+                                 '(it gets filled with synthetic data, so it must be disposable)')
+
+    def handle(self, *args, **options):
+        if options['iterations'] <= 0:
+            raise CommandError('--iterations must be positive')
+        if options['current_database']:
+            return self.benchmark(options)
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def benchmark(self, options):
+        started = time.perf_counter()
+        dataset = generate_dataset(
+            options['sensors'], options['days'], options['reading_period'], options['tasks'], options['plants'],
+            seed=options['seed'], progress=self.stdout.write
+        )
+        self.stdout.write(f'Generated dataset in {time.perf_counter() - started:.1f} s')
+
+        rng = random.Random(options['seed'])
+        client = Client()
+        results = []
+        with mock.patch.object(views, 'UPLOAD_PASSWORD', BENCHMARK_PASSWORD):
+            for name, request in self.scenarios(dataset, rng, options['upload_size']):
+                result = dict(name=name, **self.run_scenario(client, request, options['iterations'], options['warm_cache']))
+                results.append(result)
+                self.stdout.write(
+                    f"{name:<32} p50 {result['p50_ms']:>9.2f} ms   p99 {result['p99_ms']:>9.2f} ms   "
+                    f"{result['queries']:>3} queries   peak {result['peak_memory_kb']:>9.1f} KiB"
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'commit': self.git_commit(),
+                    'time': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                    'dataset': {key: options[key] for key in ['sensors', 'days', 'reading_period', 'tasks', 'plants', 'seed']},
+                    'iterations': options['iterations'],
+                    'warm_cache': options['warm_cache'],
+                    'results': results,
+                }, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    # (name, request) pairs, where request() sends one request with the test client and returns its response
+    def scenarios(self, dataset, rng, upload_size):
+        sensors, plants = dataset['sensors'], dataset['plants']
+        last_time = dataset['last_reading_time']
+
+        def sensor_data(params):
+            return lambda client: client.get(reverse('sensor_data', args=[rng.choice(sensors).id]), params)
+
+        def sensor_update(client):
+            nonlocal last_time
+            sensor = rng.choice(sensors)
+            samples = [[last_time + i + 1, round(rng.random(), 3)] for i in range(upload_size)]
+            last_time += upload_size
+            return client.post(reverse('sensor_update'), json.dumps({
+                'password': BENCHMARK_PASSWORD,
+                'sensors': [{'sensor_name': sensor.name, 'samples': samples}],
+            }), content_type='application/json')
+
+        return [
+            ('home', lambda client: client.get(reverse('home'))),
+            ('sensor_list', lambda client: client.get(reverse('sensor_list'))),
+            ('plant_details', lambda client: client.get(reverse('plant_details', args=[rng.choice(plants).id]))),
+            ('next_tasks', lambda client: client.get(reverse('next_tasks'))),
+            ('sensor_data (full history)', sensor_data({})),
+            ('sensor_data (raw, last day)', sensor_data({'start': last_time - 86400, 'resolution': 'raw'})),
+            ('sensor_data (binary, 30 days)', sensor_data({'start': last_time - 30 * 86400, 'format': 'bin'})),
+            (f'sensor_update ({upload_size} samples)', sensor_update),
+        ]
+
+    def run_scenario(self, client, request, iterations, warm_cache):
+        def send():
+            if not warm_cache:
+                cache.clear()
+            response = request(client)
+            if response.status_code != 200:
+                raise CommandError(f'request failed with status code {response.status_code}')
+            if response.streaming:
+                b''.join(response)
+            return response
+
+        send()      # warm up (imports, template loading, connection setup)
+        latencies, queries = [], []
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                send()
+                latencies.append(time.perf_counter() - started)
+            queries.append(len(context.captured_queries))
+
+        # measured separately, since tracing allocations slows requests down
+        tracemalloc.start()
+        try:
+            send()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        latencies.sort()
+        return {
+            'iterations': iterations,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p99_ms': 1000 * percentile(latencies, 99),
+            'mean_ms': 1000 * statistics.mean(latencies),
+            'queries': int(statistics.median(queries)),
+            'max_queries': max(queries),
+            'peak_memory_kb': peak / 1024,
+        }
+
+    @staticmethod
+    def git_commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
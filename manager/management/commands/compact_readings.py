@@ -0,0 +1,172 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+
+from collections import defaultdict
+import math
+from datetime import datetime, timedelta
+
+from manager.cache import bump_versions, sensor_scopes
+from manager.models import Sensor, SensorReading, SensorRollup, UploadReceipt
+
+
+# how long upload idempotency keys are remembered (clients replay failed uploads well within this)
+UPLOAD_RECEIPT_RETENTION = timedelta(days=30)
+
+
+# Delete the rows of queryset in batches of at most batch_size, returning the number deleted
+def delete_in_batches(queryset, batch_size):
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        queryset.model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+
+
+class Command(BaseCommand):
+    help = ('Delete sensor data older than its retention period (see SENSOR_DATA_RETENTION), '
+            'after making sure it is summarized by the next coarser rollup, then reclaim space')
+
+    def add_arguments(self, parser):
+        retention = settings.SENSOR_DATA_RETENTION
+        # (whole days, so that cutoffs fall on day boundaries)
+        parser.add_argument('--raw-days', type=int, default=self.days(retention['raw']),
+                            help='days of raw readings to keep (default: %(default)s)')
+        parser.add_argument('--hourly-days', type=int, default=self.days(retention['hour']),
+                            help='days of hourly rollups to keep (default: %(default)s)')
+        parser.add_argument('--daily-days', type=int, default=self.days(retention['day']),
+                            help='days of daily rollups to keep (default: %(default)s)')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='maximum number of rows deleted per statement')
+        parser.add_argument('--no-vacuum', action='store_false', dest='vacuum',
+                            help='do not VACUUM the database afterwards')
+
+    # retention in whole days (rounded up, so that no data younger than the retention period is removed)
+    @staticmethod
+    def days(retention):
+        return None if retention is None else math.ceil(retention / timedelta(days=1))
+
+    def handle(self, *args, raw_days=None, hourly_days=None, daily_days=None, batch_size=1000, vacuum=True, **options):
+        if batch_size <= 0:
+            raise CommandError('--batch-size must be positive')
+        # daily rollups summarize everything older, so they must outlive the finer data (otherwise charts
+        # would lose history that is still stored, and expired daily rollups would be rebuilt from hourly ones)
+        if daily_days is not None and any(days is None or days > daily_days for days in (raw_days, hourly_days)):
+            raise CommandError('daily rollups must be kept at least as long as raw readings and hourly rollups')
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        for sensor in Sensor.objects.order_by('id'):
+            changed = False
+            if raw_days is not None:
+                # cutoffs fall on day boundaries so that only whole buckets are ever removed
+                cutoff = today - timedelta(days=raw_days)
+                rebuilt = self.ensure_rollups_from_raw(sensor, cutoff)
+                deleted = delete_in_batches(
+                    SensorReading.objects.filter(sensor=sensor, time__lt=cutoff), batch_size
+                )
+                changed |= bool(rebuilt or deleted)
+                self.stdout.write(f'{sensor}: rebuilt {rebuilt} day(s) of rollups, deleted {deleted} raw readings')
+
+            if hourly_days is not None:
+                cutoff = today - timedelta(days=hourly_days)
+                rebuilt = self.ensure_daily_from_hourly(sensor, cutoff)
+                deleted = delete_in_batches(
+                    SensorRollup.objects.filter(sensor=sensor, resolution=SensorRollup.HOUR, start__lt=cutoff),
+                    batch_size
+                )
+                changed |= bool(rebuilt or deleted)
+                self.stdout.write(f'{sensor}: rebuilt {rebuilt} daily rollups, deleted {deleted} hourly rollups')
+
+            if daily_days is not None:
+                cutoff = today - timedelta(days=daily_days)
+                deleted = delete_in_batches(
+                    SensorRollup.objects.filter(sensor=sensor, resolution=SensorRollup.DAY, start__lt=cutoff),
+                    batch_size
+                )
+                changed |= bool(deleted)
+                self.stdout.write(f'{sensor}: deleted {deleted} daily rollups')
+
+            if changed:
+                # invalidate the sensor's cached pages and data ETags once (deletions and bulk writes
+                # send no invalidating signals, see manager/signals.py)
+                bump_versions(sensor_scopes([sensor.id]))
+
+        deleted = delete_in_batches(
+            UploadReceipt.objects.filter(received_time__lt=today - UPLOAD_RECEIPT_RETENTION), batch_size
+        )
+        self.stdout.write(f'Deleted {deleted} upload receipts')
+
+        if vacuum and connection.vendor in ('sqlite', 'postgresql'):
+            self.stdout.write('Reclaiming space...')
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+
+    # Rebuild, from raw readings, every day before cutoff whose hourly or daily rollups
+    # hold fewer readings than the raw table does (e.g. history from before rollups existed)
+    def ensure_rollups_from_raw(self, sensor, cutoff):
+        raw_counts = defaultdict(int)
+        rows = SensorReading.objects.filter(sensor=sensor, time__lt=cutoff) \
+            .annotate(bucket=TruncHour('time')).values_list('bucket').annotate(count=Count('id'))
+        for bucket, count in rows:
+            raw_counts[(SensorRollup.HOUR, bucket)] = count
+            raw_counts[(SensorRollup.DAY, SensorRollup.bucket_start(SensorRollup.DAY, bucket))] += count
+        if not raw_counts:
+            return 0
+
+        rollup_counts = dict(
+            ((resolution, start), count) for resolution, start, count in SensorRollup.objects.filter(
+                sensor=sensor, start__lt=cutoff
+            ).values_list('resolution', 'start', 'count')
+        )
+        stale_days = sorted({
+            SensorRollup.bucket_start(SensorRollup.DAY, start)
+            for (resolution, start), count in raw_counts.items()
+            if rollup_counts.get((resolution, start), 0) < count
+        })
+
+        for day in stale_days:
+            next_day = day + timedelta(days=1)
+            buckets = SensorRollup.aggregate(
+                SensorReading.objects.filter(sensor=sensor, time__gte=day, time__lt=next_day)
+            )
+            with transaction.atomic():
+                SensorRollup.objects.filter(sensor=sensor, start__gte=day, start__lt=next_day).delete()
+                SensorRollup.objects.bulk_create(buckets.values())
+        return len(stale_days)
+
+    # Rebuild, from hourly rollups, every daily rollup before cutoff that summarizes fewer readings
+    def ensure_daily_from_hourly(self, sensor, cutoff):
+        hourly = SensorRollup.objects.filter(
+            sensor=sensor, resolution=SensorRollup.HOUR, start__lt=cutoff
+        ).order_by('start')
+        days = defaultdict(list)
+        for rollup in hourly.iterator():
+            days[SensorRollup.bucket_start(SensorRollup.DAY, rollup.start)].append(rollup)
+        daily = {
+            rollup.start: rollup for rollup in SensorRollup.objects.filter(
+                sensor=sensor, resolution=SensorRollup.DAY, start__lt=cutoff
+            )
+        }
+
+        rebuilt = []
+        for day, hours in days.items():
+            count = sum(hour.count for hour in hours)
+            if day in daily and daily[day].count >= count:
+                continue
+            last = max(hours, key=lambda hour: hour.last_time)
+            rebuilt.append(SensorRollup(
+                sensor=sensor, resolution=SensorRollup.DAY, start=day, count=count,
+                min=min(hour.min for hour in hours),
+                max=max(hour.max for hour in hours),
+                mean=sum(hour.mean * hour.count for hour in hours) / count,
+                last=last.last, last_time=last.last_time,
+            ))
+
+        with transaction.atomic():
+            SensorRollup.objects.filter(pk__in=[daily[r.start].pk for r in rebuilt if r.start in daily]).delete()
+            SensorRollup.objects.bulk_create(rebuilt, batch_size=500)
+        return len(rebuilt)
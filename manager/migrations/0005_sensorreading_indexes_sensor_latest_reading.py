@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-18 02:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_latest_readings(apps, schema_editor):
+    Sensor = apps.get_model('manager', 'Sensor')
+    SensorReading = apps.get_model('manager', 'SensorReading')
+    for sensor in Sensor.objects.all():
+        sensor.latest_reading = SensorReading.objects.filter(sensor=sensor).order_by('time').last()
+        sensor.save(update_fields=['latest_reading'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0004_auto_20200717_1453'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensor',
+            name='latest_reading',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='manager.sensorreading'),
+        ),
+        migrations.AddIndex(
+            model_name='sensorreading',
+            index=models.Index(fields=['sensor', 'time'], name='manager_sen_sensor__870064_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sensorreading',
+            index=models.Index(fields=['time'], name='manager_sen_time_2b014a_idx'),
+        ),
+        migrations.RunPython(set_latest_readings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.14 on 2026-10-18 03:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0006_sensorrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='last_modified_time',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 02:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0007_task_last_modified_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadReceipt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('received_time', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0008_uploadreceipt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('completed_at', models.DateTimeField()),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='manager.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['task', 'completed_at'], name='manager_tas_task_id_b2e336_idx'), models.Index(fields=['completed_at', 'id'], name='manager_tas_complet_988fc3_idx')],
+            },
+        ),
+    ]
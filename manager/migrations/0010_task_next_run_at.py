@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:40
+
+from django.db import migrations, models
+
+
+def set_next_run_at(apps, schema_editor):
+    Task = apps.get_model('manager', 'Task')
+    tasks = list(Task.objects.all())
+    for task in tasks:
+        task.next_run_at = task.last_completed_time + task.period
+    Task.objects.bulk_update(tasks, ['next_run_at'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manager', '0009_taskrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='next_run_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(set_next_run_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='task',
+            name='next_run_at',
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['next_run_at'], name='manager_tas_next_ru_9b611a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['enabled', 'next_run_at'], name='manager_tas_enabled_1dc109_idx'),
+        ),
+    ]
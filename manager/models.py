@@ -1,6 +1,9 @@
 from django.db import models
+from django.db.models import OuterRef, Q, Subquery
 from django.utils import timezone
 
+from datetime import timedelta
+
 
 class Task(models.Model):
     name = models.CharField(max_length=60)
@@ -12,37 +15,208 @@ class Task(models.Model):
 
     enabled = models.BooleanField(default=True)
 
+    # updated on every save (used to validate cached task lists)
+    last_modified_time = models.DateTimeField(auto_now=True, db_index=True)
+
+    # stored copy of next_scheduled_time (kept in sync by save) so tasks can be ordered and filtered by it in the database
+    # (QuerySet.update() bypasses save: set it there too when updating last_completed_time or period)
+    next_run_at = models.DateTimeField(editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_run_at']),
+            models.Index(fields=['enabled', 'next_run_at']),
+        ]
+
     @property
     def next_scheduled_time(self):
         return self.last_completed_time + self.period
     
     def is_overdue(self):
-        return self.next_scheduled_time < timezone.now()
+        return self.next_run_at < timezone.now()
+
+    # tasks due before the given time (a range scan of the next_run_at index)
+    @staticmethod
+    def due_before(time):
+        return Task.objects.filter(next_run_at__lt=time)
+
+    def save(self, *args, **kwargs):
+        self.next_run_at = self.next_scheduled_time
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'last_completed_time', 'period'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'next_run_at'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.name}'
 
 
+# A completion of a task reported by the client
+class TaskRun(models.Model):
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='runs')
+    completed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['task', 'completed_at']),
+            models.Index(fields=['completed_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'{self.task} {self.completed_at}'
+
+
 class SensorReading(models.Model):
     sensor = models.ForeignKey('Sensor', on_delete=models.CASCADE)
     value = models.DecimalField(max_digits=5, decimal_places=3)
     time = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['sensor', 'time']),
+            models.Index(fields=['time']),
+        ]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        Sensor.advance_latest_reading(self)
+        if adding:
+            SensorRollup.update_rollups([self])
+
     def __str__(self):
         return f'{self.sensor} {self.time}'
 
 
 class Sensor(models.Model):
     name = models.CharField(max_length=60)
+    # denormalized pointer to the most recent reading (kept up to date on ingest)
+    latest_reading = models.ForeignKey(
+        SensorReading, null=True, blank=True, editable=False,
+        on_delete=models.SET_NULL, related_name='+'
+    )
+
+    # point the reading's sensor at it, unless the sensor already has a newer one
+    @staticmethod
+    def advance_latest_reading(reading):
+        Sensor.objects.filter(pk=reading.sensor_id).filter(
+            Q(latest_reading__isnull=True) | Q(latest_reading__time__lte=reading.time)
+        ).update(latest_reading=reading)
+
+    # recompute the latest reading pointer of the given sensors (one UPDATE, used after bulk inserts)
+    @staticmethod
+    def refresh_latest_readings(sensor_ids):
+        latest = SensorReading.objects.filter(sensor=OuterRef('pk')).order_by('-time', '-id')
+        Sensor.objects.filter(pk__in=sensor_ids).update(
+            latest_reading=Subquery(latest.values('pk')[:1])
+        )
 
-    @property
-    def latest_reading(self):
-        return SensorReading.objects.filter(sensor=self.id).latest('time')
-    
     def __str__(self):
         return f'{self.name}'
 
 
+class SensorRollup(models.Model):
+    HOUR = 'hour'
+    DAY = 'day'
+    RESOLUTIONS = [
+        (HOUR, 'Hourly'),
+        (DAY, 'Daily'),
+    ]
+    BUCKET_SIZES = {
+        HOUR: timedelta(hours=1),
+        DAY: timedelta(days=1),
+    }
+
+    sensor = models.ForeignKey(Sensor, on_delete=models.CASCADE)
+    resolution = models.CharField(max_length=4, choices=RESOLUTIONS)
+    start = models.DateTimeField()      # start of the bucket
+
+    count = models.PositiveIntegerField()
+    min = models.FloatField()
+    max = models.FloatField()
+    mean = models.FloatField()
+    last = models.FloatField()          # value of the latest reading in the bucket
+    last_time = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sensor', 'resolution', 'start'], name='unique_sensor_rollup_bucket'),
+        ]
+
+    @staticmethod
+    def bucket_start(resolution, time):
+        if resolution == SensorRollup.HOUR:
+            return time.replace(minute=0, second=0, microsecond=0)
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    # fold a (time, value) sample into the bucket's aggregates
+    def add_sample(self, time, value):
+        if self.count:
+            self.mean += (value - self.mean) / (self.count + 1)
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+            self.count += 1
+        else:
+            self.mean = self.min = self.max = value
+            self.count = 1
+        if self.last_time is None or time >= self.last_time:
+            self.last = value
+            self.last_time = time
+
+    # build the rollups of the given readings, one per (sensor, resolution, bucket) touched
+    @staticmethod
+    def aggregate(readings):
+        buckets = {}
+        for reading in readings:
+            value = float(reading.value)
+            for resolution, _ in SensorRollup.RESOLUTIONS:
+                key = (reading.sensor_id, resolution, SensorRollup.bucket_start(resolution, reading.time))
+                if key not in buckets:
+                    buckets[key] = SensorRollup(sensor_id=key[0], resolution=resolution, start=key[2], count=0)
+                buckets[key].add_sample(reading.time, value)
+        return buckets
+
+    # incrementally merge newly ingested readings into the stored rollups
+    @staticmethod
+    def update_rollups(readings):
+        buckets = SensorRollup.aggregate(readings)
+        if not buckets:
+            return
+
+        sensor_ids = {sensor_id for sensor_id, _, _ in buckets}
+        starts = [start for _, _, start in buckets]
+        existing = {
+            (rollup.sensor_id, rollup.resolution, rollup.start): rollup
+            for rollup in SensorRollup.objects.filter(
+                sensor__in=sensor_ids, start__gte=min(starts), start__lte=max(starts)
+            )
+        }
+
+        new_rollups, updated_rollups = [], []
+        for key, bucket in buckets.items():
+            rollup = existing.get(key)
+            if rollup is None:
+                new_rollups.append(bucket)
+                continue
+            total = rollup.mean * rollup.count + bucket.mean * bucket.count
+            rollup.count += bucket.count
+            rollup.mean = total / rollup.count
+            rollup.min = min(rollup.min, bucket.min)
+            rollup.max = max(rollup.max, bucket.max)
+            if bucket.last_time >= rollup.last_time:
+                rollup.last = bucket.last
+                rollup.last_time = bucket.last_time
+            updated_rollups.append(rollup)
+
+        SensorRollup.objects.bulk_create(new_rollups, batch_size=500)
+        SensorRollup.objects.bulk_update(
+            updated_rollups, ['count', 'min', 'max', 'mean', 'last', 'last_time'], batch_size=500
+        )
+
+    def __str__(self):
+        return f'{self.sensor} {self.resolution} {self.start}'
+
+
 class Plant(models.Model):
     name = models.CharField(max_length=60)
     # associated tasks and sensors
@@ -57,3 +231,12 @@ class Plant(models.Model):
 
     def __str__(self):
         return f'{self.name}'
+
+
+# Idempotency key of an upload that was already applied (so that replayed uploads are ignored)
+class UploadReceipt(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    received_time = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.key}'
@@ -0,0 +1,43 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_versions, plant_scopes, sensor_scopes, task_scopes
+from .models import Task, Sensor, SensorReading, Plant
+
+
+# Invalidate cached pages when objects are edited one at a time (e.g. in the admin)
+# Bulk writes (which send no signals) bump the versions themselves, see ingest.py
+
+@receiver([post_save, post_delete], sender=Task)
+def task_changed(sender, instance, **kwargs):
+    bump_versions(task_scopes([instance.id]))
+
+
+@receiver([post_save, post_delete], sender=Sensor)
+def sensor_changed(sender, instance, **kwargs):
+    bump_versions(sensor_scopes([instance.id]))
+
+
+# (not on post_delete: readings are deleted by the thousand by compact_readings, which bumps once per sensor)
+@receiver(post_save, sender=SensorReading)
+def sensor_reading_changed(sender, instance, **kwargs):
+    bump_versions(sensor_scopes([instance.sensor_id]))
+
+
+@receiver([post_save, post_delete], sender=Plant)
+def plant_changed(sender, instance, **kwargs):
+    bump_versions(plant_scopes([instance.id]))
+
+
+# a plant's tasks or sensors were added or removed (from either side of the relation)
+@receiver(m2m_changed, sender=Plant.tasks.through)
+@receiver(m2m_changed, sender=Plant.sensors.through)
+def plant_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            bump_versions(plant_scopes([instance.id]))
+    elif action == 'pre_clear':
+        # the plants are only known before they are cleared
+        bump_versions(plant_scopes(instance.plant_set.values_list('id', flat=True)))
+    elif action in ('post_add', 'post_remove'):
+        bump_versions(plant_scopes(pk_set))
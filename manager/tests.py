@@ -1,3 +1,732 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
 
-# Create your tests here.
+import json
+import queue
+import tempfile
+from io import StringIO
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from BonsaiBuddyServer.metrics import clear_metrics, METRICS_CONTENT_TYPE
+
+from . import views
+from .encoding import decode_series, SERIES_CONTENT_TYPE
+from .ingest import ingest_readings, ingest_uploads
+from .ingest_queue import ingest_queue
+from .models import Task, TaskRun, Sensor, SensorReading, SensorRollup, Plant
+
+
+def create_sensors(count, readings_per_sensor=3):
+    sensors = []
+    for i in range(count):
+        sensor = Sensor.objects.create(name=f'sensor {i}')
+        for j in range(readings_per_sensor):
+            SensorReading.objects.create(
+                sensor=sensor,
+                value=j / 10,
+                time=datetime(2020, 1, 1) + timedelta(hours=j)
+            )
+        sensors.append(sensor)
+    return sensors
+
+
+def create_tasks(count):
+    return [Task.objects.create(
+        name=f'task {i}',
+        description='',
+        command='NOOP',
+        period=timedelta(days=1),
+        last_completed_time=datetime(2020, 1, 1)
+    ) for i in range(count)]
+
+
+class SensorListQueryCountTests(TestCase):
+    def test_query_count_is_independent_of_sensor_count(self):
+        create_sensors(1)
+        with self.assertNumQueries(1):
+            self.client.get(reverse('sensor_list'))
+
+        create_sensors(10)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('sensor_list'))
+        self.assertContains(response, '<b>0.200</b>', count=11)
+
+    def test_sensor_without_readings(self):
+        Sensor.objects.create(name='empty')
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('sensor_list'))
+        self.assertContains(response, 'none found')
+
+
+class PlantDetailsQueryCountTests(TestCase):
+    def test_query_count_is_independent_of_related_objects(self):
+        plant = Plant.objects.create(name='roberto')
+        plant.sensors.set(create_sensors(1))
+        plant.tasks.set(create_tasks(1))
+        # (two of them list the plant's tasks and sensors for the page cache)
+        with self.assertNumQueries(5):
+            self.client.get(reverse('plant_details', args=[plant.id]))
+
+        plant.sensors.add(*create_sensors(10))
+        plant.tasks.add(*create_tasks(10))
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('plant_details', args=[plant.id]))
+        self.assertContains(response, '<b>0.200</b>', count=11)
+        self.assertContains(response, 'Task ', count=11)
+
+
+@mock.patch.object(views, 'UPLOAD_PASSWORD', 'password')
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sensor_list_is_cached_until_readings_arrive(self):
+        sensor = create_sensors(1)[0]
+        self.client.get(reverse('sensor_list'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('sensor_list'))
+        self.assertContains(response, '<b>0.200</b>')
+
+        self.client.post(reverse('sensor_update'), json.dumps({'password': 'password', 'sensors': [
+            {'sensor_name': sensor.name, 'value': 0.5, 'time': datetime(2020, 2, 1).timestamp()}
+        ]}), content_type='application/json')
+        response = self.client.get(reverse('sensor_list'))
+        self.assertContains(response, '<b>0.500</b>')
+
+    def test_plant_details_is_invalidated_by_its_own_tasks_only(self):
+        plant = Plant.objects.create(name='roberto')
+        task, other_task = create_tasks(2)
+        plant.tasks.add(task)
+        url = reverse('plant_details', args=[plant.id])
+        self.client.get(url)
+
+        other_task.name = 'renamed'
+        other_task.save()
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        task.name = 'renamed'
+        task.save()
+        self.assertContains(self.client.get(url), 'Renamed')
+
+        # membership changed from the task's side of the relation
+        other_task.plant_set.add(plant)
+        self.assertContains(self.client.get(url), 'Renamed', count=2)
+
+
+class SensorDataTests(TestCase):
+    def setUp(self):
+        self.sensor = create_sensors(1, readings_per_sensor=50)[0]
+        self.url = reverse('sensor_data', args=[self.sensor.id])
+
+    def test_downsampled_series_is_capped(self):
+        data = self.client.get(self.url, {'max_points': 10, 'resolution': 'raw'}).json()['data']
+        self.assertEqual(len(data), 10)
+        self.assertEqual(data[0]['x'], datetime(2020, 1, 1).timestamp())
+        self.assertEqual(data[-1]['x'], (datetime(2020, 1, 1) + timedelta(hours=49)).timestamp())
+
+    async def test_streamed_series_matches_full_series(self):
+        response = await self.async_client.get(self.url, {'max_points': 0, 'resolution': 'raw'})
+        self.assertTrue(response.streaming)
+        data = json.loads(b''.join([chunk async for chunk in response.streaming_content]))['data']
+        self.assertEqual(len(data), 50)
+        self.assertEqual(data[1], {'x': datetime(2020, 1, 1, 1).timestamp(), 'y': 0.1})
+
+    def test_binary_series_matches_json_series(self):
+        params = {'max_points': 20, 'resolution': 'raw'}
+        data = self.client.get(self.url, params).json()['data']
+        response = self.client.get(self.url, dict(params, format='bin'))
+        self.assertEqual(response['Content-Type'], SERIES_CONTENT_TYPE)
+        points = decode_series(response.content)
+        self.assertEqual(len(response.content), 12 + 8 * 20)
+        self.assertEqual([x for x, _ in points], [point['x'] for point in data])
+        for (_, y), point in zip(points, data):
+            self.assertAlmostEqual(y, point['y'], places=5)
+
+    def test_binary_series_out_of_encoding_range(self):
+        # stored before ingest rejected such times
+        SensorReading.objects.create(sensor=self.sensor, value=0.5, time=datetime(1960, 1, 1))
+        params = {'max_points': 0, 'resolution': 'raw', 'format': 'bin'}
+        self.assertEqual(self.client.get(self.url, params).status_code, 400)
+        self.assertEqual(self.client.get(self.url, dict(params, max_points=100, format='json')).status_code, 200)
+
+    def test_time_range(self):
+        data = self.client.get(self.url, {
+            'start': datetime(2020, 1, 1, 10).timestamp(),
+            'end': datetime(2020, 1, 1, 19).timestamp(),
+        }).json()['data']
+        self.assertEqual(len(data), 10)
+
+    def test_long_ranges_use_rollups(self):
+        data = self.client.get(self.url, {'end': datetime(2021, 1, 1).timestamp()}).json()['data']
+        self.assertEqual([(point['x'], round(point['y'], 3)) for point in data], [
+            (datetime(2020, 1, 1).timestamp(), 1.15),
+            (datetime(2020, 1, 2).timestamp(), 3.55),
+            (datetime(2020, 1, 3).timestamp(), 4.85),
+        ])
+
+    def test_history_from_before_rollups_is_not_lost(self):
+        # raw readings a year older than the rollups, as before `backfill_rollups` is run
+        SensorReading.objects.bulk_create([SensorReading(
+            sensor=self.sensor, value=0.5, time=datetime(2019, 1, 1) + timedelta(days=i)
+        ) for i in range(3)])
+        with self.assertLogs('django', 'WARNING'):
+            data = self.client.get(self.url, {'max_points': 0, 'format': 'bin'}).content
+        points = decode_series(data)
+        self.assertEqual(len(points), 3 + 50)
+        self.assertEqual(points[0][0], datetime(2019, 1, 1).timestamp())
+
+        call_command('backfill_rollups', stdout=StringIO())
+        points = decode_series(self.client.get(self.url, {'max_points': 0, 'format': 'bin'}).content)
+        self.assertEqual(len(points), 3 + 3)
+        self.assertEqual(points[0][0], datetime(2019, 1, 1).timestamp())
+
+
+class SensorRollupTests(TestCase):
+    def test_incremental_rollups_match_backfill(self):
+        sensor = create_sensors(1, readings_per_sensor=30)[0]
+        ingest_readings([('sensor 0', (datetime(2020, 1, 1) + timedelta(minutes=m)).timestamp(), 0.9) for m in range(90)])
+        incremental = list(SensorRollup.objects.order_by('resolution', 'start').values())
+
+        SensorRollup.objects.all().delete()
+        call_command('backfill_rollups', stdout=StringIO())
+        backfilled = list(SensorRollup.objects.order_by('resolution', 'start').values())
+
+        self.assertEqual(len(incremental), len(backfilled))
+        for a, b in zip(incremental, backfilled):
+            for field in ['sensor_id', 'resolution', 'start', 'count', 'min', 'max', 'last', 'last_time']:
+                self.assertEqual(a[field], b[field])
+            self.assertAlmostEqual(a['mean'], b['mean'])
+        hour = SensorRollup.objects.get(sensor=sensor, resolution=SensorRollup.HOUR, start=datetime(2020, 1, 1))
+        self.assertEqual((hour.count, hour.min, hour.max, hour.last), (61, 0.0, 0.9, 0.9))
+
+
+class CompactReadingsTests(TestCase):
+    def test_old_readings_are_summarized_before_deletion(self):
+        sensor = Sensor.objects.create(name='sensor')
+        now = datetime.now()
+        # history from before rollups existed, then readings ingested with rollups
+        SensorReading.objects.bulk_create([SensorReading(
+            sensor=sensor, value=0.5, time=now - timedelta(days=100, minutes=30 * i)
+        ) for i in range(200)])
+        ingest_readings([('sensor', (now - timedelta(minutes=i)).timestamp(), 0.25) for i in range(10)])
+
+        call_command('compact_readings', raw_days=30, hourly_days=60, batch_size=7, vacuum=False, stdout=StringIO())
+
+        self.assertEqual(SensorReading.objects.filter(time__lt=now - timedelta(days=30)).count(), 0)
+        self.assertEqual(SensorReading.objects.count(), 10)
+        self.assertFalse(SensorRollup.objects.filter(resolution=SensorRollup.HOUR, start__lt=now - timedelta(days=61)).exists())
+        old_days = SensorRollup.objects.filter(resolution=SensorRollup.DAY, start__lt=now - timedelta(days=30))
+        self.assertEqual(sum(rollup.count for rollup in old_days), 200)
+        self.assertTrue(all(rollup.mean == 0.5 for rollup in old_days))
+
+    def test_daily_rollups_expire(self):
+        sensor = Sensor.objects.create(name='sensor')
+        now = datetime.now()
+        ingest_readings([('sensor', (now - timedelta(days=days)).timestamp(), 0.5) for days in [1, 100, 500]])
+
+        with self.assertRaises(CommandError):
+            call_command('compact_readings', raw_days=30, hourly_days=60, daily_days=40, stdout=StringIO())
+        call_command('compact_readings', raw_days=30, hourly_days=60, daily_days=365, vacuum=False, stdout=StringIO())
+        days = SensorRollup.objects.filter(sensor=sensor, resolution=SensorRollup.DAY)
+        self.assertEqual(days.count(), 2)
+        self.assertFalse(days.filter(start__lt=now - timedelta(days=366)).exists())
+
+    def test_cached_pages_are_invalidated_once_per_sensor(self):
+        sensor = Sensor.objects.create(name='sensor')
+        SensorReading.objects.bulk_create([SensorReading(
+            sensor=sensor, value=0.5, time=datetime.now() - timedelta(days=100, minutes=30 * i)
+        ) for i in range(50)])
+
+        with mock.patch('manager.signals.bump_versions') as signal_bump, \
+                mock.patch('manager.management.commands.compact_readings.bump_versions') as bump:
+            call_command('compact_readings', raw_days=30, batch_size=7, vacuum=False, stdout=StringIO())
+        self.assertEqual(SensorReading.objects.count(), 0)
+        signal_bump.assert_not_called()
+        bump.assert_called_once_with(['sensors', 'sensor:%d' % sensor.id])
+
+
+class BenchmarkTests(TestCase):
+    def test_results_cover_every_scenario(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('benchmark', current_database=True, sensors=2, days=3, tasks=5, plants=3, iterations=3,
+                         output=output.name, stdout=StringIO())
+            results = json.load(output)
+
+        self.assertEqual(results['dataset']['sensors'], 2)
+        # (each scenario sends a warm-up request, the timed ones, and one traced for memory)
+        self.assertEqual(SensorReading.objects.count(), 2 * 3 * 24 + (1 + 3 + 1) * 240)
+        self.assertEqual([result['name'] for result in results['results']][:4], ['home', 'sensor_list', 'plant_details', 'next_tasks'])
+        for result in results['results']:
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['peak_memory_kb'], 0)
+
+
+@mock.patch.object(views, 'UPLOAD_PASSWORD', 'password')
+class SensorUpdateTests(TestCase):
+    def setUp(self):
+        create_sensors(2, readings_per_sensor=1)
+
+    def post(self, sensors):
+        return self.client.post(
+            reverse('sensor_update'),
+            json.dumps({'password': 'password', 'sensors': sensors}),
+            content_type='application/json'
+        )
+
+    def test_single_and_batched_samples(self):
+        time = datetime(2020, 2, 1).timestamp()
+        with self.assertNumQueries(7):
+            response = self.post([
+                {'sensor_name': 'sensor 0', 'value': 0.5, 'time': time},
+                {'sensor_name': 'sensor 1', 'samples': [[time + i, i / 100] for i in range(100)]},
+            ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SensorReading.objects.count(), 2 + 101)
+        self.assertEqual(Sensor.objects.get(name='sensor 0').latest_reading.value, Decimal('0.5'))
+        self.assertEqual(Sensor.objects.get(name='sensor 1').latest_reading.value, Decimal('0.99'))
+
+    def test_replayed_upload_is_applied_once(self):
+        sensors = [{'sensor_name': 'sensor 0', 'samples': [[0, 0.1], [1, 0.2]]}]
+        for _ in range(2):
+            response = self.client.post(
+                reverse('sensor_update'),
+                json.dumps({'password': 'password', 'idempotency_key': 'abc', 'sensors': sensors}),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(SensorReading.objects.count(), 2 + 2)
+
+    def test_unknown_sensors_are_skipped_and_reported(self):
+        response = self.post([
+            {'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0},
+            {'sensor_name': 'missing', 'value': 0.5, 'time': 0},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'unknown_sensors': ['missing']})
+        self.assertEqual(SensorReading.objects.count(), 2 + 1)
+
+    def test_invalid_values_are_rejected(self):
+        for value in ['abc', 100, -100, None]:
+            response = self.post([
+                {'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0},
+                {'sensor_name': 'sensor 1', 'value': value, 'time': 0},
+            ])
+            self.assertEqual(response.status_code, 400)
+        for time in [1e20, -1e9, 2 ** 32]:
+            self.assertEqual(self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': time}]).status_code, 400)
+        self.assertEqual(SensorReading.objects.count(), 2)
+
+    def test_malformed_updates_are_rejected(self):
+        for sensors in [
+            [{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 'abc'}],
+            [{'sensor_name': 'sensor 0', 'value': 0.5}],
+            [{'sensor_name': 'sensor 0', 'samples': [[0, 0.5], [1]]}],
+            [{'sensor_name': 'sensor 0', 'samples': [0.5]}],
+            [{'sensor_name': ['sensor 0'], 'value': 0.5, 'time': 0}],
+            ['sensor 0'],
+            None,
+        ]:
+            self.assertEqual(self.post(sensors).status_code, 400, sensors)
+        for body in ['not json', '[]', json.dumps({'password': 'password', 'sensors': [], 'idempotency_key': [1]})]:
+            response = self.client.post(reverse('sensor_update'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(SensorReading.objects.count(), 2)
+
+    def test_busy_database_asks_to_retry(self):
+        with mock.patch.object(views, 'ingest_readings', side_effect=OperationalError('database is locked')):
+            response = self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(views.DATABASE_BUSY_RETRY_AFTER))
+
+    def test_wrong_password(self):
+        response = self.client.post(
+            reverse('sensor_update'),
+            json.dumps({'password': 'wrong', 'sensors': []}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(SENSOR_INGEST_WRITE_BEHIND=True)
+@mock.patch.object(views, 'UPLOAD_PASSWORD', 'password')
+class WriteBehindSensorUpdateTests(TransactionTestCase):
+    # (the writer thread has its own database connection, so the uploads must really be committed)
+    def setUp(self):
+        create_sensors(2, readings_per_sensor=0)
+
+    def post(self, sensors, idempotency_key=None):
+        return self.client.post(
+            reverse('sensor_update'),
+            json.dumps({'password': 'password', 'idempotency_key': idempotency_key, 'sensors': sensors}),
+            content_type='application/json'
+        )
+
+    def test_uploads_are_accepted_then_written_in_batches(self):
+        with mock.patch.object(ingest_queue, 'write', wraps=ingest_queue.write) as write:
+            for i in range(10):
+                response = self.post([{'sensor_name': 'sensor %d' % (i % 2), 'samples': [[i, 0.1], [i + 0.5, 0.2]]}], 'key %d' % (i % 5))
+                self.assertEqual(response.status_code, 202)
+            self.assertTrue(ingest_queue.flush(timeout=5))
+        # replayed keys are skipped, even within a batch
+        self.assertEqual(SensorReading.objects.count(), 5 * 2)
+        self.assertLess(write.call_count, 10)
+        self.assertEqual(Sensor.objects.get(name='sensor 1').latest_reading.value, Decimal('0.2'))
+
+    def test_unknown_sensors_are_skipped_before_queueing(self):
+        response = self.post([{'sensor_name': 'missing', 'value': 0.5, 'time': 0},
+                              {'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'unknown_sensors': ['missing']})
+        self.assertTrue(ingest_queue.flush(timeout=5))
+        self.assertEqual(SensorReading.objects.count(), 1)
+
+    def test_invalid_values_are_rejected_before_queueing(self):
+        self.assertEqual(self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}], 'k1').status_code, 202)
+        for value in ['abc', 1000, None, float('nan')]:
+            response = self.post([{'sensor_name': 'sensor 0', 'value': value, 'time': 1}], 'k2')
+            self.assertEqual(response.status_code, 400)
+        self.assertTrue(ingest_queue.flush(timeout=5))
+        self.assertEqual(SensorReading.objects.count(), 1)
+
+    def test_busy_database_is_retried(self):
+        calls = []
+
+        def locked_once(uploads):
+            calls.append(uploads)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return ingest_uploads(uploads)
+
+        with mock.patch('manager.ingest_queue.ingest_uploads', side_effect=locked_once), \
+                mock.patch('manager.ingest_queue.WRITE_RETRY_DELAY', 0), self.assertLogs('django', 'WARNING'):
+            self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}])
+            self.assertTrue(ingest_queue.flush(timeout=5))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(SensorReading.objects.count(), 1)
+
+    def test_failing_upload_does_not_lose_the_rest_of_its_batch(self):
+        def fail_bad_upload(uploads):
+            if any(key == 'bad' for _, key in uploads):
+                raise ValueError('bad upload')
+            return ingest_uploads(uploads)
+
+        with mock.patch('manager.ingest_queue.ingest_uploads', side_effect=fail_bad_upload), \
+                self.assertLogs('django', 'ERROR'):
+            self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}], 'good')
+            self.post([{'sensor_name': 'sensor 1', 'value': 0.5, 'time': 0}], 'bad')
+            self.post([{'sensor_name': 'sensor 1', 'value': 0.5, 'time': 1}], 'also good')
+            self.assertTrue(ingest_queue.flush(timeout=5))
+        self.assertEqual(SensorReading.objects.count(), 2)
+
+    def test_full_queue(self):
+        with mock.patch.object(ingest_queue, 'put', side_effect=queue.Full):
+            response = self.post([{'sensor_name': 'sensor 0', 'value': 0.5, 'time': 0}])
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+class ConditionalGetTests(TestCase):
+    def test_next_tasks_not_modified_until_a_task_changes(self):
+        task = create_tasks(2)[0]
+        response = self.client.get(reverse('next_tasks'))
+        with self.assertNumQueries(1):
+            unchanged = self.client.get(reverse('next_tasks'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.content, b'')
+
+        task.last_completed_time = datetime(2020, 1, 2)
+        task.save()
+        changed = self.client.get(reverse('next_tasks'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+
+        task.delete()
+        self.assertNotEqual(self.client.get(reverse('next_tasks'))['ETag'], changed['ETag'])
+
+    def test_sensor_data_not_modified_until_a_reading_arrives(self):
+        sensor = create_sensors(1)[0]
+        url = reverse('sensor_data', args=[sensor.id])
+        response = self.client.get(url)
+        unchanged = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(self.client.get(url, {'format': 'bin'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+        ingest_readings([('sensor 0', datetime(2020, 1, 2).timestamp(), 0.5)])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_sensor_data_modified_by_older_readings_and_rollup_rebuilds(self):
+        sensor = create_sensors(1)[0]
+        url = reverse('sensor_data', args=[sensor.id])
+        etag = self.client.get(url)['ETag']
+
+        # replayed after an outage, older than the latest reading
+        ingest_readings([('sensor 0', datetime(2019, 12, 31).timestamp(), 0.5)])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        call_command('backfill_rollups', stdout=StringIO())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+@mock.patch.object(views, 'UPLOAD_PASSWORD', 'password')
+class NotifyTaskTests(TestCase):
+    def post(self, content):
+        return self.client.post(
+            reverse('notify_task'),
+            json.dumps(dict(content, password='password')),
+            content_type='application/json'
+        )
+
+    def test_single_completion(self):
+        task = create_tasks(1)[0]
+        self.assertEqual(self.post({'task_id': task.id, 'completion_time': datetime(2020, 2, 1).timestamp()}).status_code, 200)
+        task.refresh_from_db()
+        self.assertEqual(task.last_completed_time, datetime(2020, 2, 1))
+
+    def test_batched_completions_never_move_tasks_back(self):
+        first, second = create_tasks(2)
+        response = self.post({'idempotency_key': 'abc', 'completions': [
+            {'task_id': first.id, 'completion_time': datetime(2020, 2, 2).timestamp()},
+            {'task_id': first.id, 'completion_time': datetime(2020, 2, 1).timestamp()},
+            {'task_id': second.id, 'completion_time': datetime(2020, 2, 3).timestamp()},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.last_completed_time, datetime(2020, 2, 2))
+        self.assertEqual(second.last_completed_time, datetime(2020, 2, 3))
+        # every completion is recorded, even those too old to move the task
+        self.assertEqual(first.runs.count(), 2)
+        self.assertEqual(second.runs.count(), 1)
+
+    def test_unknown_tasks_are_skipped_and_reported(self):
+        task = create_tasks(1)[0]
+        response = self.post({'completions': [
+            {'task_id': 1234, 'completion_time': datetime(2020, 2, 1).timestamp()},
+            {'task_id': task.id, 'completion_time': datetime(2020, 2, 1).timestamp()},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'unknown_tasks': [1234]})
+        task.refresh_from_db()
+        self.assertEqual(task.last_completed_time, datetime(2020, 2, 1))
+        self.assertEqual(TaskRun.objects.count(), 1)
+
+    def test_malformed_completions_are_rejected(self):
+        task = create_tasks(1)[0]
+        for content in [
+            {'task_id': task.id, 'completion_time': 1e20},
+            {'task_id': task.id},
+            {'task_id': 'abc', 'completion_time': 0},
+            {'completions': [{'task_id': task.id, 'completion_time': 0}, {'completion_time': 0}]},
+            {'completions': 5},
+        ]:
+            self.assertEqual(self.post(content).status_code, 400, content)
+        self.assertEqual(TaskRun.objects.count(), 0)
+
+    def test_task_ids_given_as_strings(self):
+        task = create_tasks(1)[0]
+        response = self.post({'task_id': str(task.id), 'completion_time': datetime(2020, 2, 1).timestamp()})
+        self.assertEqual(response.json(), {'unknown_tasks': []})
+        self.assertEqual(task.runs.count(), 1)
+
+    def test_busy_database_asks_to_retry(self):
+        task = create_tasks(1)[0]
+        with mock.patch.object(views, 'complete_tasks', side_effect=OperationalError('database is locked')):
+            response = self.post({'task_id': task.id, 'completion_time': 0})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+class TaskScheduleTests(TestCase):
+    def test_next_run_at_follows_completion_and_period(self):
+        task = create_tasks(1)[0]
+        self.assertEqual(task.next_run_at, datetime(2020, 1, 2))
+
+        task.last_completed_time = datetime(2020, 2, 1)
+        task.save(update_fields=['last_completed_time'])
+        task.period = timedelta(hours=1)
+        task.save()
+        task.refresh_from_db()
+        self.assertEqual(task.next_run_at, datetime(2020, 2, 1, 1))
+
+    def test_task_list_order_and_filters(self):
+        now = datetime.now()
+        tasks = create_tasks(4)
+        for task, last_completed in zip(tasks, [now, now - timedelta(hours=12), now - timedelta(days=2), now - timedelta(hours=23)]):
+            task.last_completed_time = last_completed
+            task.save()
+
+        def listed(params):
+            # one query counts the tasks, the other fetches the page
+            with self.assertNumQueries(2):
+                response = self.client.get(reverse('task_list'), params)
+            return [task.id for task in response.context['tasks']]
+
+        self.assertEqual(listed({}), [tasks[i].id for i in [2, 3, 1, 0]])
+        self.assertEqual(listed({'overdue': 1}), [tasks[2].id])
+        self.assertEqual(listed({'due_within': 6}), [tasks[2].id, tasks[3].id])
+        self.assertEqual(self.client.get(reverse('task_list'), {'due_within': 'soon'}).status_code, 400)
+
+        with mock.patch.object(views, 'TASK_LIST_PAGE_SIZE', 3):
+            self.assertEqual(listed({'page': 2}), [tasks[0].id])
+
+    def test_next_tasks_in_due_order(self):
+        first, second = create_tasks(2)
+        first.period = timedelta(days=3)
+        first.save()
+        response = self.client.get(reverse('next_tasks'))
+        self.assertEqual([task['task_id'] for task in response.json()['scheduled_tasks']], [second.id, first.id])
+        self.assertEqual(response.json()['scheduled_tasks'][0]['next_time'], datetime(2020, 1, 2).timestamp())
+
+
+class TaskHistoryTests(TestCase):
+    def setUp(self):
+        self.first, self.second = create_tasks(2)
+        # two runs per timestamp, so that pages also split runs completed at the same time
+        TaskRun.objects.bulk_create([
+            TaskRun(task=task, completed_at=datetime(2020, 1, 1) + timedelta(hours=i // 2))
+            for i in range(10) for task in [self.first, self.second]
+        ])
+
+    def fetch_all(self, params):
+        runs, pages = [], 0
+        while True:
+            with self.assertNumQueries(1):
+                response = self.client.get(reverse('task_runs'), params)
+            content = response.json()
+            runs += content['runs']
+            pages += 1
+            if content['next'] is None:
+                return runs, pages
+            params = dict(params, before=content['next'])
+
+    def test_pages_cover_every_run_once_newest_first(self):
+        runs, pages = self.fetch_all({'limit': 3})
+        self.assertEqual(pages, 7)
+        self.assertEqual([run['run_id'] for run in runs],
+                         list(TaskRun.objects.order_by('-completed_at', '-id').values_list('id', flat=True)))
+
+    def test_runs_of_one_task(self):
+        runs, pages = self.fetch_all({'limit': 4, 'task': self.second.id})
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(runs), 10)
+        self.assertTrue(all(run['task_name'] == 'task 1' for run in runs))
+
+    def test_history_page(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('task_history'), {'task': self.first.id})
+        self.assertContains(response, 'Task #%d ("task 0")' % self.first.id, count=10)
+        self.assertNotContains(response, 'Older')
+
+        with mock.patch.object(views, 'TASK_HISTORY_PAGE_SIZE', 4):
+            response = self.client.get(reverse('task_history'))
+        self.assertContains(response, 'completed at', count=4)
+        self.assertContains(response, 'Older')
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('task_history'), {'before': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('task_runs'), {'limit': 0}).status_code, 400)
+
+
+@mock.patch.object(views, 'TASKS_LONG_POLL_INTERVAL', 0.05)
+class NextTasksLongPollTests(TestCase):
+    # (AsyncClient takes headers by their HTTP name, without the HTTP_ prefix)
+    def setUp(self):
+        self.task = create_tasks(1)[0]
+        self.etag = self.client.get(reverse('next_tasks'))['ETag']
+
+    async def test_answers_immediately_without_known_etag(self):
+        response = await self.async_client.get(reverse('next_tasks_wait'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.etag)
+
+    async def test_not_modified_after_timeout(self):
+        response = await self.async_client.get(
+            reverse('next_tasks_wait'), {'timeout': 0.2}, **{'If-None-Match': self.etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_rejects_timeouts_that_never_expire(self):
+        for timeout in ['nan', 'inf', 'abc']:
+            response = await self.async_client.get(
+                reverse('next_tasks_wait'), {'timeout': timeout}, **{'If-None-Match': self.etag}
+            )
+            self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get(
+            reverse('next_tasks_wait'), {'timeout': -5}, **{'If-None-Match': self.etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_answers_as_soon_as_tasks_change(self):
+        # edit the task while the request is held (on its third check); editing it from another
+        # coroutine would wait for the held request, since the test database is bound to one thread
+        calls = []
+        next_tasks_etag = views.next_tasks_etag
+
+        def edit_task_then_check(request):
+            calls.append(request)
+            if len(calls) == 3:
+                self.task.command = 'NOOP 2'
+                self.task.save()
+            return next_tasks_etag(request)
+
+        with mock.patch.object(views, 'next_tasks_etag', side_effect=edit_task_then_check):
+            response = await self.async_client.get(
+                reverse('next_tasks_wait'), {'timeout': 5}, **{'If-None-Match': self.etag}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 3)
+        self.assertNotEqual(response['ETag'], self.etag)
+        self.assertEqual(response.json()['scheduled_tasks'][0]['command'], 'NOOP 2')
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_metrics()
+
+    def test_records_latency_queries_and_size_per_view(self):
+        create_sensors(2)
+        response = self.client.get(reverse('sensor_list'))
+        metrics = self.client.get(reverse('metrics'))
+        self.assertEqual(metrics['Content-Type'], METRICS_CONTENT_TYPE)
+        self.assertContains(metrics, 'bonsaibuddy_request_duration_seconds_count{view="sensor_list",method="GET",status="200"} 1')
+        self.assertContains(metrics, 'bonsaibuddy_request_db_queries_bucket{view="sensor_list",method="GET",le="0"} 0')
+        self.assertContains(metrics, 'bonsaibuddy_request_db_queries_bucket{view="sensor_list",method="GET",le="1"} 1')
+        self.assertContains(metrics, 'bonsaibuddy_response_size_bytes_sum{view="sensor_list",method="GET"} %s' % float(len(response.content)))
+
+        # served from the page cache
+        self.client.get(reverse('sensor_list'))
+        metrics = self.client.get(reverse('metrics'))
+        self.assertContains(metrics, 'bonsaibuddy_request_db_queries_bucket{view="sensor_list",method="GET",le="0"} 1')
+        self.assertContains(metrics, 'bonsaibuddy_request_duration_seconds_count{view="metrics",method="GET",status="200"} 1')
+
+    async def test_counts_queries_of_async_and_streamed_responses(self):
+        sensor = await Sensor.objects.acreate(name='sensor 0')
+        await SensorReading.objects.acreate(sensor=sensor, value=0.5, time=datetime(2020, 1, 1))
+        await self.async_client.get(reverse('next_tasks'))
+        response = await self.async_client.get(reverse('sensor_data', args=[sensor.id]), {'resolution': 'raw', 'max_points': 0})
+        self.assertTrue(response.streaming)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+
+        metrics = (await self.async_client.get(reverse('metrics'))).content.decode()
+        # the etag query and the task list query
+        self.assertIn('bonsaibuddy_request_db_queries_sum{view="next_tasks",method="GET"} 2.0', metrics)
+        # the etag query, and the readings query run while streaming
+        self.assertIn('bonsaibuddy_request_db_queries_sum{view="sensor_data",method="GET"} 2.0', metrics)
+        self.assertIn('bonsaibuddy_response_size_bytes_sum{view="sensor_data",method="GET"} %s' % float(len(content)), metrics)
+
+    def test_logs_slow_requests_with_their_queries(self):
+        with override_settings(SLOW_REQUEST_THRESHOLD=0), self.assertLogs('django', 'WARNING') as logs:
+            self.client.get(reverse('sensor_list'))
+        self.assertIn('Slow request: GET /sensors/ (sensor_list) answered 200', logs.output[0])
+        self.assertIn('FROM "manager_sensor"', logs.output[0])
+
+        with override_settings(SLOW_REQUEST_THRESHOLD=60), self.assertNoLogs('django', 'WARNING'):
+            self.client.get(reverse('sensor_list'))
@@ -12,7 +12,9 @@ urlpatterns = [
     path('plants/', views.plant_list, name='plant_list'),
     path('plants/<int:plant_id>', views.plant_details, name='plant_details'),
     path('next_tasks/', views.next_tasks, name='next_tasks'),
+    path('next_tasks/wait/', views.next_tasks_wait, name='next_tasks_wait'),
     path('sensor_update/', views.sensor_update, name='sensor_update'),
     path('notify_task/', views.notify_task_completed, name='notify_task'),
     path('task_history/', views.task_history, name='task_history'),
+    path('task_history/runs/', views.task_runs, name='task_runs'),
 ]
\ No newline at end of file
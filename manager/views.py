@@ -1,29 +1,46 @@
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import get_object_or_404, render
-from django.views.decorators.csrf import csrf_exempt
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.core.paginator import Paginator
+from django.shortcuts import get_object_or_404, render
+from django.db import OperationalError
+from django.db.models import Count, Max, Prefetch, Q
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from asgiref.sync import sync_to_async
 
 import json
+import hashlib
+import asyncio
+import math
+import queue
 from datetime import datetime, timedelta
-import logging, os
+import os
+import logging
 
-from .models import Task, Sensor, SensorReading, Plant
+from .models import Task, TaskRun, Sensor, SensorReading, SensorRollup, Plant
+from .cache import cache_page_versioned, get_versions, PAGE_CACHE_TIMEOUT
+from .downsampling import lttb
+from .encoding import encode_series, SERIES_CONTENT_TYPE
+from .ingest import parse_sensor_update, validate_samples, ingest_readings
+from .ingest import parse_task_completions, validate_completions, complete_tasks
+from .ingest_queue import ingest_queue
 
 
-
-# Get an instance of a named logger
-logger = logging.getLogger('tasks')
+logger = logging.getLogger('django')
 
 
 # The longest the client can be silent for and still be considered 'OK'
 CLIENT_SILENCE_PERIOD = timedelta(hours=1)
 
+@cache_page_versioned(lambda request: ['sensors'])
 def home(request):
-    try:
-        last_update_time = SensorReading.objects.latest('time').time
+    # most recent reading across all sensors (via each sensor's latest reading pointer)
+    last_update_time = Sensor.objects.aggregate(time=Max('latest_reading__time'))['time']
+    if last_update_time is not None:
         client_ok = datetime.now() - last_update_time < CLIENT_SILENCE_PERIOD
-    except SensorReading.DoesNotExist:
-        last_update_time = None #datetime(year=1, month=1, day=1)
+    else:
         client_ok = False
     
     return render(
@@ -36,13 +53,40 @@ def home(request):
     )
 
 
+# the request's URL with the given query parameters replaced (for pagination links)
+def url_with_params(request, **params):
+    query = request.GET.copy()
+    for key, value in params.items():
+        query[key] = value
+    return '?' + query.urlencode()
+
+
+# number of tasks per page of the task list
+TASK_LIST_PAGE_SIZE = 100
+
+# Tasks in the order they are due, optionally only those overdue (?overdue=1) or due within some hours (?due_within=24)
+# Ordering and filtering both run on the next_run_at index
+@cache_page_versioned(lambda request: ['tasks'])
 def task_list(request):
-    tasks = list(Task.objects.all())
-    tasks.sort(key=lambda t: t.next_scheduled_time)
+    tasks = Task.objects.order_by('next_run_at', 'id')
+    try:
+        if request.GET.get('overdue'):
+            tasks = Task.due_before(datetime.now()).order_by('next_run_at', 'id')
+        elif request.GET.get('due_within'):
+            due_within = timedelta(hours=float(request.GET['due_within']))
+            tasks = Task.due_before(datetime.now() + due_within).order_by('next_run_at', 'id')
+    except (ValueError, OverflowError) as e:
+        return HttpResponseBadRequest(str(e))
+
+    page = Paginator(tasks, TASK_LIST_PAGE_SIZE).get_page(request.GET.get('page'))
     return render(
         request,
         'manager/task_list.html',
-        {'tasks': tasks}
+        {
+            'tasks': page,
+            'previous_page_url': url_with_params(request, page=page.previous_page_number()) if page.has_previous() else None,
+            'next_page_url': url_with_params(request, page=page.next_page_number()) if page.has_next() else None,
+        }
     )
 
 
@@ -55,8 +99,9 @@ def task_details(request, task_id):
     )
 
 
+@cache_page_versioned(lambda request: ['sensors'])
 def sensor_list(request):
-    sensors = Sensor.objects.order_by('name')
+    sensors = Sensor.objects.order_by('name').select_related('latest_reading')
     return render(
         request,
         'manager/sensor_list.html',
@@ -64,20 +109,152 @@ def sensor_list(request):
     )
 
 
-def sensor_data(request, sensor_id):
-    readings = SensorReading.objects.filter(sensor=sensor_id).all()
+# default cap on the number of points returned to the chart (0 means no cap)
+DEFAULT_MAX_POINTS = 1000
+
+# number of readings fetched from the database (and written to the response) at a time
+STREAM_CHUNK_SIZE = 2000
+
+# serialize (time, value) rows as {"data": [{"x": ..., "y": ...}, ...]} one chunk at a time
+def stream_json_points(rows, chunk_size=STREAM_CHUNK_SIZE):
+    yield '{"data": ['
+    separator = ''
+    chunk = []
+    for time, value in rows:
+        chunk.append(f'{separator}{{"x": {time.timestamp()!r}, "y": {float(value)!r}}}')
+        separator = ', '
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk) + ']}'
+
+
+# Async iterator over a synchronous one whose items need the database, advanced in a worker thread
+# (Django would otherwise collect a synchronous iterator in memory before sending an ASGI response)
+async def iterate_in_thread(iterator):
+    done = object()
+    while True:
+        item = await sync_to_async(next)(iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+# longest time spans served from raw readings and from hourly rollups (longer spans use daily rollups)
+RAW_DATA_MAX_SPAN = timedelta(days=7)
+HOURLY_DATA_MAX_SPAN = timedelta(days=180)
+
+DATA_RESOLUTIONS = ['auto', 'raw', SensorRollup.HOUR, SensorRollup.DAY]
+DATA_FORMATS = ['json', 'bin']
+
+# pick the coarsest data needed to draw the given time span
+def resolution_for_span(span):
+    if span <= RAW_DATA_MAX_SPAN:
+        return 'raw'
+    if span <= HOURLY_DATA_MAX_SPAN:
+        return SensorRollup.HOUR
+    return SensorRollup.DAY
+
+
+# The series changes when readings arrive (possibly older than the latest one, e.g. replayed after an
+# outage, so the highest reading id is used rather than the latest reading), and when rollups are
+# rebuilt or data is compacted, which bump the sensor's cache version (see manager/cache.py).
+# Together with the request itself they identify the response.
+def sensor_data_etag(request, sensor_id):
+    max_reading_id = SensorReading.objects.filter(sensor=sensor_id).aggregate(Max('id'))['id__max']
+    version = get_versions(['sensor:%d' % sensor_id])[0]
+    key = '%s:%s:%s:%s' % (max_reading_id, version, request.get_full_path(), request.headers.get('Accept', ''))
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+# the parameters of a sensor_data request: (start, end, max_points, resolution, data_format)
+# Raises ValueError (or OverflowError, OSError) if they are malformed
+def parse_sensor_data_params(request):
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    max_points = int(request.GET.get('max_points', DEFAULT_MAX_POINTS))
+    if max_points < 0:
+        raise ValueError('max_points must be non-negative')
+    resolution = request.GET.get('resolution', 'auto')
+    if resolution not in DATA_RESOLUTIONS:
+        raise ValueError('resolution must be one of %s' % ', '.join(DATA_RESOLUTIONS))
+    accepts_bin = SERIES_CONTENT_TYPE in request.headers.get('Accept', '')
+    data_format = request.GET.get('format', 'bin' if accepts_bin else 'json')
+    if data_format not in DATA_FORMATS:
+        raise ValueError('format must be one of %s' % ', '.join(DATA_FORMATS))
+    start = datetime.fromtimestamp(float(start)) if start else None
+    end = datetime.fromtimestamp(float(end)) if end else None
+    return start, end, max_points, resolution, data_format
+
+
+def sensor_data_response(sensor_id, start, end, max_points, resolution, data_format):
+    if resolution == 'auto':
+        # an open-ended range starts at the sensor's first daily rollup or first raw reading, whichever is
+        # earlier: rollups only exist for readings ingested since they were introduced until `manage.py
+        # backfill_rollups` is run, and raw readings are removed by compaction once rolled up
+        first_rollup_time = SensorRollup.objects.filter(
+            sensor=sensor_id, resolution=SensorRollup.DAY
+        ).order_by('start').values_list('start', flat=True).first()
+        first_raw_time = SensorReading.objects.filter(
+            sensor=sensor_id
+        ).order_by('time').values_list('time', flat=True).first()
+        first_time = start or min(filter(None, [first_rollup_time, first_raw_time]), default=None)
+        span = (end or datetime.now()) - first_time if first_time else timedelta(0)
+        resolution = resolution_for_span(span)
+        # rollups not backfilled yet: only raw readings cover the history before the first rollup
+        rollups_start = first_rollup_time or datetime.max
+        if resolution != 'raw' and first_raw_time and first_raw_time < rollups_start and first_time < rollups_start:
+            logger.warning('Sensor #%s has raw readings older than its rollups, run `manage.py backfill_rollups`'
+                           % sensor_id)
+            resolution = 'raw'
+
+    if resolution == 'raw':
+        series = SensorReading.objects.filter(sensor=sensor_id)
+        time_field, value_field = 'time', 'value'
+    else:
+        series = SensorRollup.objects.filter(sensor=sensor_id, resolution=resolution)
+        time_field, value_field = 'start', 'mean'
+    if start is not None:
+        series = series.filter(**{f'{time_field}__gte': start})
+    if end is not None:
+        series = series.filter(**{f'{time_field}__lte': end})
+    rows = series.order_by(time_field).values_list(time_field, value_field).iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+    # full resolution: stream rows straight from the cursor instead of building the whole series
+    if max_points == 0 and data_format == 'json':
+        return StreamingHttpResponse(iterate_in_thread(stream_json_points(rows)), content_type='application/json')
+
+    points = [(time.timestamp(), float(value)) for time, value in rows]
+    if data_format == 'bin':
+        try:
+            content = encode_series(lttb(points, max_points))
+        except ValueError as e:
+            # (readings stored before their times were validated; format=json can still serve them)
+            return HttpResponseBadRequest(str(e))
+        return HttpResponse(content, content_type=SERIES_CONTENT_TYPE)
     data = [{
-        'x': reading.time.timestamp(),
-        'y': float(reading.value)
-    } for reading in readings]
-    data.sort(key=lambda item: item['x'])
+        'x': x,
+        'y': y
+    } for x, y in lttb(points, max_points)]
     return JsonResponse({
         'data': data
     })
 
 
-# maximum number of categories 
-MAX_CATEGORIES = 100
+async def sensor_data(request, sensor_id):
+    try:
+        params = parse_sensor_data_params(request)
+    except (ValueError, OverflowError, OSError) as e:
+        return HttpResponseBadRequest(str(e))
+
+    etag = quote_etag(await sync_to_async(sensor_data_etag)(request, sensor_id))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = await sync_to_async(sensor_data_response)(sensor_id, *params)
+    response['ETag'] = etag
+    patch_vary_headers(response, ['Accept'])
+    return response
+
 
 def sensor_details(request, sensor_id):
     sensor = get_object_or_404(Sensor, pk=sensor_id)
@@ -88,6 +265,7 @@ def sensor_details(request, sensor_id):
     )
 
 
+@cache_page_versioned(lambda request: ['plants'])
 def plant_list(request):
     plants = Plant.objects.order_by('name')
     return render(
@@ -97,8 +275,28 @@ def plant_list(request):
     )
 
 
+# the scopes shown on a plant's page: the plant, its tasks and its sensors
+# (membership changes bump the plant's version, so the list of members is cached under it)
+def plant_details_scopes(request, plant_id):
+    plant_scope = 'plant:%d' % plant_id
+    members_key = 'members:%s:%s' % (plant_scope, get_versions([plant_scope])[0])
+    members = cache.get(members_key)
+    if members is None:
+        members = ['task:%d' % task_id for task_id in
+                   Plant.tasks.through.objects.filter(plant=plant_id).values_list('task_id', flat=True)]
+        members += ['sensor:%d' % sensor_id for sensor_id in
+                    Plant.sensors.through.objects.filter(plant=plant_id).values_list('sensor_id', flat=True)]
+        cache.set(members_key, members, PAGE_CACHE_TIMEOUT)
+    return [plant_scope] + members
+
+
+@cache_page_versioned(plant_details_scopes)
 def plant_details(request, plant_id):
-    plant = get_object_or_404(Plant, pk=plant_id)
+    plants = Plant.objects.prefetch_related(
+        Prefetch('tasks', queryset=Task.objects.order_by('name')),
+        Prefetch('sensors', queryset=Sensor.objects.order_by('name').select_related('latest_reading')),
+    )
+    plant = get_object_or_404(plants, pk=plant_id)
     return render(
         request,
         'manager/plant_details.html',
@@ -106,21 +304,117 @@ def plant_details(request, plant_id):
     )
 
 
-def next_tasks(request):
+# every change to the task list saves a task (bumping its modification time) or deletes one
+def next_tasks_etag(request):
+    tasks = Task.objects.aggregate(count=Count('id'), modified=Max('last_modified_time'))
+    modified = tasks['modified'].timestamp() if tasks['modified'] else 0
+    return '%d-%f' % (tasks['count'], modified)
+
+
+def next_tasks_content():
     tasks = [{
         'task_id': task.id,
         'command': task.command,
-        'next_time': task.next_scheduled_time.timestamp()
-    } for task in Task.objects.filter(enabled=True)]
-    return JsonResponse({
+        'next_time': task.next_run_at.timestamp()
+    } for task in Task.objects.filter(enabled=True).order_by('next_run_at')]
+    return {
         'scheduled_tasks': tasks
-    })
+    }
+
+
+async def next_tasks_response(etag):
+    response = JsonResponse(await sync_to_async(next_tasks_content)())
+    response['ETag'] = etag
+    return response
+
+
+async def next_tasks(request):
+    etag = quote_etag(await sync_to_async(next_tasks_etag)(request))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        return await next_tasks_response(etag)
+    response['ETag'] = etag
+    return response
+
+
+# default and maximum time a long-poll for task changes is held open (below Heroku's 30 s router timeout)
+TASKS_LONG_POLL_TIMEOUT = 25
+# how often the held request checks whether the task list changed (seconds)
+TASKS_LONG_POLL_INTERVAL = 1
+
+# Long-poll variant of next_tasks: hold the request until the task list no longer matches the
+# client's If-None-Match ETag (then answer like next_tasks) or until the timeout expires (304)
+async def next_tasks_wait(request):
+    try:
+        timeout = float(request.GET.get('timeout', TASKS_LONG_POLL_TIMEOUT))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    # (a NaN timeout would never expire)
+    if not math.isfinite(timeout):
+        return HttpResponseBadRequest('timeout must be a finite number of seconds')
+    timeout = min(max(timeout, 0), TASKS_LONG_POLL_TIMEOUT)
+    known_etags = parse_etags(request.headers.get('If-None-Match', ''))
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        current_etag = quote_etag(await sync_to_async(next_tasks_etag)(request))
+        if current_etag not in known_etags:
+            return await next_tasks_response(current_etag)
+        if loop.time() >= deadline:
+            response = HttpResponseNotModified()
+            response['ETag'] = current_etag
+            return response
+        await asyncio.sleep(min(TASKS_LONG_POLL_INTERVAL, deadline - loop.time()))
 
 
 UPLOAD_PASSWORD = os.environ.get('UPLOAD_PASSWORD')     # provided by heroku Config Vars
 
-@csrf_exempt
-def sensor_update(request):
+# csrf_exempt for async views (Django's decorator hides them behind a synchronous wrapper)
+def async_csrf_exempt(view):
+    view.csrf_exempt = True
+    return view
+
+# how long (seconds) clients should wait before retrying when the ingest queue is full
+INGEST_QUEUE_RETRY_AFTER = 5
+
+# how long (seconds) clients should wait before retrying when the database is busy (e.g. locked by another writer)
+DATABASE_BUSY_RETRY_AFTER = 5
+
+# the upload's optional idempotency key; raises TypeError if it is not a string
+def parse_idempotency_key(content):
+    key = content.get('idempotency_key')
+    if key is not None and not isinstance(key, str):
+        raise TypeError('idempotency_key must be a string, not %r' % (key,))
+    return key
+
+# 400 for an upload that can never be applied, which the client drops
+def malformed_upload(error):
+    return HttpResponseBadRequest('malformed upload: %s %s' % (type(error).__name__, error))
+
+# 503 asking the client to retry after the given number of seconds (the client's Transport retries 503s)
+def retry_later(retry_after):
+    response = HttpResponse(status=503)
+    response['Retry-After'] = retry_after
+    return response
+
+# Queue the (validated) samples for the background writer (202), or ask the client to retry later (503)
+# Samples of unknown sensors are skipped and reported, like ingest_readings does
+def queue_sensor_update(samples, idempotency_key):
+    names = {name for name, _, _ in samples}
+    unknown = sorted(names - set(Sensor.objects.filter(name__in=names).values_list('name', flat=True)))
+    samples = [sample for sample in samples if sample[0] not in unknown]
+
+    if samples:
+        try:
+            ingest_queue.put(samples, idempotency_key)
+        except queue.Full:
+            return retry_later(INGEST_QUEUE_RETRY_AFTER)
+    return JsonResponse({'unknown_sensors': unknown}, status=202)
+
+
+@async_csrf_exempt
+async def sensor_update(request):
     if request.method != 'POST':
         return HttpResponse()
 
@@ -128,25 +422,30 @@ def sensor_update(request):
         content = json.loads(request.body)
         if content['password'] != UPLOAD_PASSWORD:
             return HttpResponse(status=403)
+        samples = parse_sensor_update(content['sensors'])
+        idempotency_key = parse_idempotency_key(content)
+    except (KeyError, TypeError, ValueError) as e:
+        # (a 500 would be retried by the client forever, holding back every later upload)
+        return malformed_upload(e)
 
-        new_readings = [
-            SensorReading(
-                sensor=Sensor.objects.get(name=s['sensor_name']),
-                value=s['value'],
-                time=datetime.fromtimestamp(s['time'])
-            ) for s in content['sensors']
-        ]
-
-        for new_reading in new_readings:
-            new_reading.save()
-
-        return HttpResponse()
+    try:
+        validate_samples(samples)
+        if settings.SENSOR_INGEST_WRITE_BEHIND:
+            return await sync_to_async(queue_sensor_update)(samples, idempotency_key)
+        unknown = await sync_to_async(ingest_readings)(samples, idempotency_key)
+
+        # report the sensors whose readings were skipped (see ingest_uploads)
+        return JsonResponse({'unknown_sensors': unknown})
+    except ValidationError as e:
+        return HttpResponseBadRequest('; '.join(e.messages))
+    except OperationalError:
+        return retry_later(DATABASE_BUSY_RETRY_AFTER)
     except Exception as e:
         return HttpResponse(status=500)
 
 
-@csrf_exempt
-def notify_task_completed(request):
+@async_csrf_exempt
+async def notify_task_completed(request):
     if request.method != 'POST':
         return HttpResponse()
 
@@ -154,30 +453,92 @@ def notify_task_completed(request):
         content = json.loads(request.body)
         if content['password'] != UPLOAD_PASSWORD:
             return HttpResponse(status=403)
-        
-        task = Task.objects.get(pk=content['task_id'])
-        task.last_completed_time = datetime.fromtimestamp(content['completion_time'])
-        task.save()
-        # print(f'Task updated!!! ({task})')
-        logger.info(f'Task #{task.id} (\"{task.name}\") completed at {task.last_completed_time}')
+        completions = parse_task_completions(content)
+        idempotency_key = parse_idempotency_key(content)
+    except (KeyError, TypeError, ValueError) as e:
+        # (the client replays completions before readings, so a 500 would hold back both)
+        return malformed_upload(e)
 
-        return HttpResponse()
-    except Exception as e:
-        print(e)
+    try:
+        validate_completions(completions)
+        unknown = await sync_to_async(complete_tasks)(completions, idempotency_key)
+
+        return JsonResponse({'unknown_tasks': unknown})
+    except ValidationError as e:
+        return HttpResponseBadRequest('; '.join(e.messages))
+    except OperationalError:
+        return retry_later(DATABASE_BUSY_RETRY_AFTER)
+    except Exception:
+        logger.exception('Failed to record task completions')
         return HttpResponse(status=500)
 
 
-TASKS_LOG_FILENAME = os.path.join(settings.LOGS_DIR, 'tasks.log')
+# number of task runs per page of task history (and the most the JSON API returns at once)
+TASK_HISTORY_PAGE_SIZE = 50
+TASK_HISTORY_MAX_PAGE_SIZE = 500
+
+# pages are keyed on the (completed_at, id) of the last run shown, e.g. "20200717T145300.000000_42"
+TASK_RUN_CURSOR_TIME_FORMAT = '%Y%m%dT%H%M%S.%f'
+
+def encode_task_run_cursor(run):
+    return '%s_%d' % (run.completed_at.strftime(TASK_RUN_CURSOR_TIME_FORMAT), run.id)
+
+def decode_task_run_cursor(cursor):
+    completed_at, run_id = cursor.split('_')
+    return datetime.strptime(completed_at, TASK_RUN_CURSOR_TIME_FORMAT), int(run_id)
+
+
+# One page of task runs (newest first, optionally of a single task) and the cursor of the next page
+# Keyset pagination: each page is a range scan of the (completed_at, id) or (task, completed_at) index,
+# so it costs the same however long the history grows
+# Raises ValueError on malformed parameters
+def task_runs_page(request, page_size):
+    runs = TaskRun.objects.select_related('task').order_by('-completed_at', '-id')
+    task_id = request.GET.get('task')
+    if task_id:
+        runs = runs.filter(task=int(task_id))
+    cursor = request.GET.get('before')
+    if cursor:
+        completed_at, run_id = decode_task_run_cursor(cursor)
+        runs = runs.filter(Q(completed_at__lt=completed_at) | Q(completed_at=completed_at, id__lt=run_id))
+
+    # fetch one extra run to learn whether there is a next page
+    runs = list(runs[:page_size + 1])
+    next_cursor = encode_task_run_cursor(runs[page_size - 1]) if len(runs) > page_size else None
+    return runs[:page_size], next_cursor
+
+
 def task_history(request):
-    task_logs = []
-    if os.path.isfile(TASKS_LOG_FILENAME):
-        with open(TASKS_LOG_FILENAME, 'r') as f:
-            task_logs += f.read().split('\n')
-    
-    # strip off log timestamps, exclude empty strings, and reverse order
-    task_logs = [l[32:] for l in task_logs if l][::-1]
+    try:
+        runs, next_cursor = task_runs_page(request, TASK_HISTORY_PAGE_SIZE)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
     return render(
         request,
         'manager/task_history.html',
-        {'task_logs': task_logs}
+        {
+            'runs': runs,
+            'next_page_url': url_with_params(request, before=next_cursor) if next_cursor else None,
+        }
     )
+
+
+def task_runs(request):
+    try:
+        page_size = int(request.GET.get('limit', TASK_HISTORY_PAGE_SIZE))
+        if not 0 < page_size <= TASK_HISTORY_MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and %d' % TASK_HISTORY_MAX_PAGE_SIZE)
+        runs, next_cursor = task_runs_page(request, page_size)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    return JsonResponse({
+        'runs': [{
+            'run_id': run.id,
+            'task_id': run.task_id,
+            'task_name': run.task.name,
+            'completed_at': run.completed_at.timestamp()
+        } for run in runs],
+        'next': next_cursor
+    })